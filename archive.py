@@ -0,0 +1,40 @@
+import gzip
+import json
+import os
+
+class RequestArchive:
+    '''
+    Append-only, gzip-compressed archive of resolved limited requests, one NDJSON file per guild
+
+    Every append adds a new gzip member to the end of the guild's file, so existing data is never rewritten, and
+    reading decompresses the concatenated members as a single stream.
+    '''
+    def __init__(self, path='archive'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, guild_id):
+        return os.path.join(self.path, f'{guild_id}.ndjson.gz')
+
+    # records is an iterable of (message id, request) pairs
+    def append(self, guild_id, records):
+        lines = [json.dumps(dict(request, message_id=int(message_id))) for message_id, request in records]
+        if not lines: return 0
+
+        with gzip.open(self._file(guild_id), 'at', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+        return len(lines)
+
+    # Streams the guild's archived requests, oldest first, without loading the whole file. Appends may run on another
+    # thread meanwhile; a member that's still being written ends the stream early.
+    def iter(self, guild_id):
+        if not os.path.exists(self._file(guild_id)): return
+
+        with gzip.open(self._file(guild_id), 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    if not line.endswith('\n'): return
+                    if line.strip(): yield json.loads(line)
+            except EOFError:
+                return
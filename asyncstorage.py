@@ -0,0 +1,150 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import itertools
+import threading
+import time
+
+from consts import *
+
+class RWLock:
+    '''Lets any number of readers in at once, or a single writer; a waiting writer holds off new readers'''
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers: self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+class AsyncStorage:
+    '''
+    Awaitable front end to a storage engine, as bot.db
+
+    Every call runs on a worker thread, so disk I/O and JSON encoding never block the event loop. Writes are queued
+    on a single writer thread and run in the order they were made. Engines with concurrent_reads (SQLite) are read
+    from a pool of reader threads, which only wait for a write in progress; other engines are read on the writer
+    thread, in order with the writes.
+    '''
+    def __init__(self, storage, *, readers=4):
+        self.storage = storage
+        self.lock = RWLock()
+        self.writer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='storage-writer')
+        self.reader = (concurrent.futures.ThreadPoolExecutor(readers, thread_name_prefix='storage-reader')
+            if storage.concurrent_reads else self.writer)
+
+        self.reads = 0
+        self.writes = 0
+        self.read_time = 0.0
+        self.write_time = 0.0
+        self.queued = 0
+
+    # Runs fn(*args) on a reader thread and returns its result
+    async def read(self, fn, *args):
+        return await self._run(self.reader, self.lock.reading, fn, args, False)
+
+    # Runs fn(*args) on the writer thread and returns its result
+    async def write(self, fn, *args):
+        return await self._run(self.writer, self.lock.writing, fn, args, True)
+
+    async def get(self, guild_id):
+        return await self.read(self.storage.get, guild_id)
+
+    async def contains(self, guild_id):
+        return await self.read(self.storage.contains, guild_id)
+
+    async def insert(self, doc):
+        return await self.write(self.storage.insert, doc)
+
+    async def set(self, guild_id, key, val):
+        return await self.write(self.storage.set, guild_id, key, val)
+
+    async def delete(self, guild_id, key):
+        return await self.write(self.storage.delete, guild_id, key)
+
+    async def remove(self, guild_id):
+        return await self.write(self.storage.remove, guild_id)
+
+    async def apply(self, ops):
+        return await self.write(self.storage.apply, ops)
+
+    # Commits the queue of a write-behind storage (journal.JournaledStorage), if there is one
+    async def flush(self):
+        if hasattr(self.storage, 'flush'): await self.write(self.storage.flush)
+
+    # Iterates the documents of the guilds for which owns(guild_id) is true, reading chunk_size documents per worker
+    # call. The engines iterate a snapshot, so writes made in between chunks don't disturb the iteration.
+    async def docs(self, owns=None, *, chunk_size=STORAGE_READ_CHUNK):
+        docs = await self.read(self.storage.docs, owns)
+
+        while True:
+            chunk = await self.read(lambda: list(itertools.islice(docs, chunk_size)))
+            if not chunk: return
+
+            for doc in chunk:
+                yield doc
+
+    # Waits for queued calls to finish and closes the underlying storage
+    def close(self):
+        self.reader.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+        self.storage.close()
+
+    def stats(self):
+        return {
+            'reads': self.reads,
+            'writes': self.writes,
+            'queued': self.queued,
+            'avg_read_time': self.read_time / self.reads if self.reads else 0.0,
+            'avg_write_time': self.write_time / self.writes if self.writes else 0.0
+        }
+
+    # Statistics are updated back on the event loop, so worker threads never share them
+    async def _run(self, executor, lock, fn, args, write):
+        def call():
+            with lock():
+                start = time.perf_counter()
+                return fn(*args), time.perf_counter() - start
+
+        self.queued += 1
+        try:
+            result, elapsed = await asyncio.get_event_loop().run_in_executor(executor, call)
+        finally:
+            self.queued -= 1
+
+        if write:
+            self.writes += 1
+            self.write_time += elapsed
+        else:
+            self.reads += 1
+            self.read_time += elapsed
+
+        return result
@@ -0,0 +1,230 @@
+import asyncio
+import itertools
+import sys
+import types
+
+# The benchmarks never connect to Discord; fall back to a stand-in config if the instance has none
+try:
+    import config
+except ImportError:
+    config = types.ModuleType('config')
+    config.token = None
+    config.prefix = '!'
+    config.greenTick = 'greenTick:1'
+    config.redTick = 'redTick:2'
+    sys.modules['config'] = config
+
+import discord
+
+from asyncstorage import AsyncStorage
+from cache import GuildCache
+from deletions import DeletionBatcher
+from members import MemberCache
+import metrics
+import outbound
+
+snowflakes = itertools.count(800000000000000000)
+
+def snowflake():
+    return next(snowflakes)
+
+class FakeRole:
+    def __init__(self, guild, role_id, name, position):
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+        self.position = position
+        self.color = self.colour = discord.Colour.default()
+        self.managed = False
+        self.hoist = False
+        self.mentionable = False
+
+    def __str__(self):
+        return self.name
+
+    def is_default(self):
+        return self.id == self.guild.id
+
+class FakeMessage:
+    def __init__(self, channel, message_id=None):
+        self.channel = channel
+        self.id = message_id or snowflake()
+        self.embeds = []
+        self.attachments = []
+
+    async def add_reaction(self, emoji): pass
+    async def remove_reaction(self, emoji, member): pass
+    async def clear_reactions(self): pass
+    async def delete(self, *, delay=None): pass
+
+    async def edit(self, **fields):
+        if 'embed' in fields: self.embeds = [fields['embed']]
+
+class FakeChannel:
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+
+    def __str__(self):
+        return f'#{self.id}'
+
+    async def send(self, content=None, *, embed=None, file=None, delete_after=None):
+        message = FakeMessage(self)
+        if embed: message.embeds = [embed]
+        return message
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self, message_id)
+
+    def permissions_for(self, member):
+        return discord.Permissions.all()
+
+    async def delete_messages(self, messages):
+        if len(messages) > 100: raise discord.ClientException('Can only bulk delete messages up to 100 messages')
+
+class FakeMember:
+    def __init__(self, guild, user_id):
+        self.guild = guild
+        self.id = user_id
+        self.bot = False
+        self.roles = []
+        self.avatar_url = ''
+
+    def __str__(self):
+        return f'user#{self.id}'
+
+    async def add_roles(self, *roles, reason=None, atomic=True):
+        self.roles.extend(roles)
+
+    async def remove_roles(self, *roles, reason=None, atomic=True):
+        self.roles = [r for r in self.roles if r not in roles]
+
+    async def send(self, content=None, **kwargs): pass
+
+class FakeGuild:
+    def __init__(self, guild_id, role_ids=(), channel_ids=()):
+        self.id = guild_id
+        self.chunked = True
+        self.unavailable = False
+        self.roles = [FakeRole(self, guild_id, '@everyone', 0)] + \
+            [FakeRole(self, r, f'role-{r}', i + 1) for i, r in enumerate(role_ids)]
+        self.channels = { c: FakeChannel(self, c) for c in channel_ids }
+        self.members = {}
+        self._roles = { r.id: r for r in self.roles }
+        self.me = FakeMember(self, snowflake())
+
+    def __str__(self):
+        return f'guild-{self.id}'
+
+    def get_role(self, role_id):
+        return self._roles.get(role_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    async def fetch_member(self, user_id):
+        return self.member(user_id)
+
+    def member(self, user_id):
+        if user_id not in self.members: self.members[user_id] = FakeMember(self, user_id)
+        return self.members[user_id]
+
+class FakeHTTP:
+    '''Answers the raw requests made by components.py and roleupdates.py'''
+    def __init__(self):
+        self.routes = []
+
+    async def request(self, route, *, json=None, **kwargs):
+        self.routes.append((route.method, route.path))
+        return { 'id': str(snowflake()) } if route.method == 'POST' and route.path.endswith('/messages') else None
+
+    async def add_role(self, guild_id, user_id, role_id, *, reason=None):
+        self.routes.append(('PUT', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}'))
+
+    async def remove_role(self, guild_id, user_id, role_id, *, reason=None):
+        self.routes.append(('DELETE', '/guilds/{guild_id}/members/{user_id}/roles/{role_id}'))
+
+    async def edit_member(self, guild_id, user_id, *, reason=None, **fields):
+        self.routes.append(('PATCH', '/guilds/{guild_id}/members/{user_id}'))
+
+class FakeBot:
+    '''Just enough of commands.Bot for the helpers in utils.py and the cogs in modules/'''
+    def __init__(self, db, loop, *, cache_size=None, enable_metrics=False):
+        self.db = AsyncStorage(db)
+        self.loop = loop
+        self.intents = discord.Intents.default()
+        self.guild_cache = GuildCache(max_size=cache_size)
+        self.member_cache = MemberCache()
+        self.metrics = metrics.Metrics(enabled=enable_metrics)
+        self.outbound = outbound.OutboundScheduler()
+        self.outbound.start(loop)
+        self.deletions = DeletionBatcher(self.outbound)
+        self.reconciled = asyncio.Event()
+        self.reconciled.set()
+        self.user = FakeMember(None, snowflake())
+        self.http = FakeHTTP()
+        self.shard_count = None
+        self._guilds = {}
+
+    @property
+    def guilds(self):
+        return list(self._guilds.values())
+
+    def add_guild(self, guild):
+        self._guilds[guild.id] = guild
+
+    def get_guild(self, guild_id):
+        return self._guilds.get(guild_id)
+
+    async def fetch_guild(self, guild_id):
+        return self._guilds[guild_id]
+
+    async def fetch_channel(self, channel_id):
+        for guild in self._guilds.values():
+            if channel_id in guild.channels: return guild.channels[channel_id]
+        raise discord.NotFound(types.SimpleNamespace(status=404, reason='Not Found'), 'Unknown Channel')
+
+    def get_user(self, user_id):
+        return None
+
+    def get_cog(self, name):
+        return None
+
+    async def wait_until_ready(self): pass
+
+    async def wait_for(self, event, *, check=None, timeout=None):
+        raise asyncio.TimeoutError
+
+class FakeContext:
+    def __init__(self, bot, guild, author, prefix='!'):
+        self.bot = bot
+        self.guild = guild
+        self.author = author
+        self.channel = next(iter(guild.channels.values()), None)
+        self.message = FakeMessage(self.channel)
+        self.prefix = prefix
+
+    async def send(self, content=None, *, embed=None, file=None, delete_after=None):
+        message = FakeMessage(self.channel)
+        if embed: message.embeds = [embed]
+        return message
+
+def interaction_payload(guild, message_id, member, custom_id, permissions=1 << 28):
+    return { 't': 'INTERACTION_CREATE', 'd': {
+        'id': str(snowflake()),
+        'application_id': str(snowflake()),
+        'token': 'token',
+        'type': 3,
+        'guild_id': str(guild.id),
+        'data': { 'custom_id': custom_id, 'component_type': 2 },
+        'message': { 'id': str(message_id) },
+        'member': { 'permissions': str(permissions),
+            'user': { 'id': str(member.id), 'username': 'user', 'discriminator': '0001' } }
+    } }
+
+def reaction_payload(guild, channel_id, message_id, member, emoji):
+    return types.SimpleNamespace(guild_id=guild.id, channel_id=channel_id, message_id=message_id, member=member,
+        emoji=emoji, user_id=member.id)
@@ -0,0 +1,344 @@
+'''
+Offline benchmarks for the storage helpers and request handling
+
+Generates a synthetic database, then drives utils.py and the LimitedRequests and RoleMenus cogs through fake bot,
+guild and context objects, so no Discord connection is needed. Results are printed and saved as JSON in benchmarks/results,
+and can be compared against an earlier run with --compare.
+
+    python -m benchmarks.run --guilds 1000 --requests 50000 --engine sqlite
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import discord
+
+from .fakes import FakeBot, FakeContext, FakeGuild, config, interaction_payload, reaction_payload, snowflake
+from .synthetic import generate
+
+from consts import ROLEMENU_MAX_ENTRIES
+import metrics
+from deletions import DeletionBatcher
+from models import Status
+from modules.limited import LimitedRequests
+from modules.rolemenu import RoleMenus
+from storage import openStorage
+import utils
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+def percentile(values, q):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def bench(name, ops, fn, *, trace_memory=False):
+    latencies = []
+    if trace_memory: tracemalloc.start()
+
+    start = time.perf_counter()
+    for i in range(ops):
+        op_start = time.perf_counter()
+        result = fn(i)
+        if asyncio.iscoroutine(result): await result
+        latencies.append(time.perf_counter() - op_start)
+    elapsed = time.perf_counter() - start
+
+    await asyncio.sleep(0) # Let background outbound work run outside of the timed section
+
+    result = {
+        'ops': ops,
+        'seconds': elapsed,
+        'throughput': ops / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+    if trace_memory:
+        result['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+
+    print(f'{name:<22} {ops:>7} ops {result["throughput"]:>12.1f} ops/s  p50 {result["p50_ms"]:>9.3f}ms  ' +
+        f'p99 {result["p99_ms"]:>9.3f}ms  rss {result["max_rss_mb"]:.0f}MB')
+    return result
+
+async def run(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='rolerequest-bench-')
+    results = {}
+
+    try:
+        print(f'Generating {args.guilds} guilds with {args.requests} requests...')
+        fakes = generate(os.path.join(workdir, 'db.json'), guilds=args.guilds, requests=args.requests, seed=args.seed)
+
+        config.archive_path = os.path.join(workdir, 'archive')
+        path = os.path.join(workdir, 'db.json' if args.engine == 'tinydb' else 'db.sqlite3')
+
+        cwd = os.getcwd()
+        os.chdir(workdir) # openStorage migrates ./db.json for the sqlite engine
+        try:
+            db = openStorage(args.engine, path)
+        finally:
+            os.chdir(cwd)
+
+        bot = FakeBot(db, asyncio.get_event_loop(), cache_size=args.cache_size)
+        for guild in fakes: bot.add_guild(guild)
+
+        # Storage runs on worker threads; the lag monitor shows how long the event loop was held up at worst
+        lag_monitor = metrics.LagMonitor(bot.metrics, interval=0.01)
+        lag_task = asyncio.ensure_future(lag_monitor.run())
+
+        cog = LimitedRequests(bot)
+        cog.expiry_task.cancel()
+        cog.retention_task.cancel()
+
+        guild_of = lambda i: fakes[rng.randrange(len(fakes))]
+        moderator = lambda guild: guild.member(snowflake())
+
+        results['rebuild_state'] = await bench('rebuild_state', 1, lambda i: cog.rebuild_state())
+        results['getGuildRecord'] = await bench('getGuildRecord', args.ops * 10,
+            lambda i: utils.getGuildRecord(bot, guild_of(i)))
+
+        async def save(i):
+            record = await utils.getGuildRecord(bot, guild_of(i))
+            record.options.hidejoins = not record.options.hidejoins
+            await utils.saveGuild(bot, record)
+
+        results['saveGuild'] = await bench('saveGuild', args.write_ops, save)
+
+        async def role_lookup(i):
+            guild = guild_of(i)
+            index = await utils.getRoleIndex(bot, guild)
+            return index.get(rng.choice(guild.requestable)), index.ordered(guild)
+
+        results['role_lookup'] = await bench('role_lookup', args.ops * 10, role_lookup)
+
+        created = []
+        async def create(i):
+            guild = guild_of(i)
+            ctx = FakeContext(bot, guild, guild.member(rng.choice(guild.users)))
+            role = guild.get_role(rng.choice(guild.requestable))
+
+            await cog.request_create(ctx, role)
+            created.append((ctx, role))
+
+        results['request_create'] = await bench('request_create', args.write_ops, create)
+        results['request_cancel'] = await bench('request_cancel', len(created) // 2,
+            lambda i: cog.request_cancel(*created[i]))
+
+        # Approve the rest of the new requests through their buttons
+        approvable = []
+        for ctx, role in created[len(created) // 2:]:
+            message_id, _ = (await utils.getRequestIndex(bot, ctx.guild)).latest_request(ctx.author.id, role.id)
+            approvable.append(interaction_payload(ctx.guild, message_id, moderator(ctx.guild),
+                f'limited:approve:{ctx.author.id}:{role.id}'))
+
+        saved = cog.update_stats['rest_calls_saved']
+        results['interaction'] = await bench('interaction', len(approvable),
+            lambda i: cog.on_socket_response(approvable[i]))
+        results['interaction']['rest_calls_saved'] = cog.update_stats['rest_calls_saved'] - saved
+
+        # Mostly reactions on unrelated messages, with the occasional approval of a pending request
+        guild_by_id = { g.id: g for g in fakes }
+        pending = [(guild_by_id[doc['id']], request['channel'], int(message_id)) for doc in db
+            for message_id, request in doc['requests'].items() if request['status'] == 'pending']
+        rng.shuffle(pending)
+
+        # Five moderators approving each request at the same moment; every request must be resolved exactly once
+        storm = [pending.pop() for _ in range(min(len(pending), args.write_ops))]
+        updates, stale = cog.update_stats['updates'], cog.update_stats['stale']
+
+        async def approve_all(i):
+            guild, channel_id, message_id = storm[i]
+            await asyncio.gather(*(cog.on_raw_reaction_add(reaction_payload(guild, channel_id, message_id,
+                moderator(guild), config.greenTick)) for _ in range(5)))
+
+        results['reaction_storm'] = await bench('reaction_storm', len(storm), approve_all)
+        results['reaction_storm']['updates'] = cog.update_stats['updates'] - updates
+        results['reaction_storm']['stale'] = cog.update_stats['stale'] - stale
+        print(f'{"":<22} {results["reaction_storm"]["updates"]} updates, {results["reaction_storm"]["stale"]} stale')
+
+        async def react(i):
+            guild = guild_of(i)
+
+            if pending and i % 20 == 0:
+                guild, channel_id, message_id = pending.pop()
+                payload = reaction_payload(guild, channel_id, message_id, moderator(guild), config.greenTick)
+            else:
+                payload = reaction_payload(guild, snowflake(), snowflake(), moderator(guild), 'x')
+
+            await cog.on_raw_reaction_add(payload)
+
+        results['on_raw_reaction_add'] = await bench('on_raw_reaction_add', args.ops * 10, react)
+
+        # Clearing the backlog of the busiest guild with one command
+        busiest = max(fakes, key=lambda g: sum(1 for guild, _, _ in pending if guild is g))
+        updates, rest_calls = cog.update_stats['updates'], cog.update_stats['rest_calls']
+        results['bulk_approve'] = await bench('bulk_approve', 1, lambda i: cog.request_bulk_update(
+            FakeContext(bot, busiest, moderator(busiest)), 'all', Status.APPROVED))
+        results['bulk_approve']['requests'] = cog.update_stats['updates'] - updates
+        results['bulk_approve']['rest_calls'] = cog.update_stats['rest_calls'] - rest_calls
+        print(f'{"":<22} {results["bulk_approve"]["requests"]} requests, ' +
+            f'{results["bulk_approve"]["rest_calls"]} REST calls')
+
+        updates = cog.update_stats['updates']
+        results['expiry_check'] = await bench('expiry_check', 1, lambda i: cog.expiry_check())
+        results['expiry_check']['expired'] = cog.update_stats['updates'] - updates
+
+        # Low-memory mode: nothing is in the gateway member cache, so members come from bot.member_cache or REST
+        lean = FakeGuild(snowflake())
+        lean.get_member = lambda user_id: None
+        users = [snowflake() for _ in range(args.ops * 2)]
+
+        fetches = bot.member_cache.fetches
+        results['getMember'] = await bench('getMember', args.ops * 10,
+            lambda i: utils.getMember(bot, lean, rng.choice(users)))
+        results['getMember']['fetches'] = bot.member_cache.fetches - fetches
+        results['getMember']['hit_rate'] = bot.member_cache.stats()['hit_rate']
+
+        biggest = max(fakes, key=lambda g: len(g.roles))
+        lines = [f'<@&{r.id}> (`{r.id}`)' for r in reversed(biggest.roles)]
+        ctx = FakeContext(bot, biggest, biggest.member(snowflake()))
+        results['sendListEmbed'] = await bench('sendListEmbed', args.ops,
+            lambda i: utils.sendListEmbed(ctx, 'All Roles', lines))
+
+        # Role menus on the first guilds with open roles, loaded back from storage
+        menus = RoleMenus(bot)
+        menus.load_task.cancel()
+        menus.updates.window = 0.05
+        posted = []
+
+        for guild in fakes:
+            record = await utils.getGuildRecord(bot, guild)
+            open_roles = [role_id for role_id, role_type in record.roles.items() if role_type == 'open']
+            if not open_roles: continue
+
+            message_id = snowflake()
+            record.set_menu(message_id, { 'channel': next(iter(guild.channels)), 'buttons': False, 'entries': [
+                { 'emoji': f'<:role:{role_id}>', 'role': role_id } for role_id in open_roles[:ROLEMENU_MAX_ENTRIES]] })
+            await utils.saveGuild(bot, record)
+            posted.append((guild, message_id, open_roles[:ROLEMENU_MAX_ENTRIES]))
+            if len(posted) == 10: break
+
+        results['rolemenu_load'] = await bench('rolemenu_load', 1, lambda i: menus.load_menus())
+
+        # Members picking three roles each in quick succession, between reactions on unrelated messages
+        async def pick(i):
+            guild, message_id, role_ids = posted[i // 12 % len(posted)]
+            member = guild.member(i // 4 + 1)
+
+            if i % 4 == 3:
+                payload = reaction_payload(guild, snowflake(), snowflake(), member, 'x')
+            else:
+                payload = reaction_payload(guild, next(iter(guild.channels)), message_id, member,
+                    f'<:role:{role_ids[i % len(role_ids)]}>')
+
+            await menus.on_raw_reaction_add(payload)
+
+        results['rolemenu_dispatch'] = await bench('rolemenu_dispatch', args.ops * 12, pick)
+        await asyncio.sleep(menus.updates.window * 2)
+        while bot.outbound.queued() or menus.updates.pending or len(menus.updates.locks):
+            await asyncio.sleep(0.01)
+
+        results['rolemenu_dispatch'].update(menus.updates.stats())
+        print(f'{"":<22} {menus.updates.changes} role changes in {menus.updates.calls} calls, ' +
+            f'{menus.updates.stats()["calls_saved"]} calls saved')
+
+        # Hidden join commands and their replies, deleted in per-channel batches; every tenth message is too old to be
+        # bulk deleted
+        batcher = DeletionBatcher(bot.outbound, window=0.05)
+        channels = [channel for guild in fakes[:5] for channel in guild.channels.values()]
+        fresh = discord.utils.time_snowflake(datetime.datetime.utcnow())
+
+        results['deletions'] = await bench('deletions', args.ops * 10, lambda i: batcher.schedule(
+            channels[i % len(channels)], snowflake() if i % 10 == 0 else fresh + i))
+        await asyncio.sleep(batcher.window * 2)
+        while bot.outbound.queued() or batcher.pending: await asyncio.sleep(0.01)
+
+        results['deletions'].update(batcher.stats())
+        print(f'{"":<22} {batcher.bulk_calls} bulk and {batcher.single_calls} single deletes, ' +
+            f'{batcher.stats()["calls_saved"]} calls saved')
+
+        lag_task.cancel()
+        results['event_loop_lag'] = { 'max_ms': lag_monitor.max * 1000 }
+        print(f'{"event_loop_lag":<22} max {lag_monitor.max * 1000:.3f}ms')
+
+        # Let background work (DMs, reactions, paginators) finish before tearing down
+        while bot.outbound.queued(): await asyncio.sleep(0.01)
+        bot.outbound.stop()
+
+        others = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        await asyncio.gather(*others, return_exceptions=True)
+        bot.db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def compare(results, path):
+    with open(path, encoding='utf-8') as f:
+        previous = json.load(f)['results']
+
+    print(f'\nCompared to {path}:')
+    for name, result in results.items():
+        if name not in previous or 'throughput' not in result: continue
+
+        old = previous[name]
+        speedup = result['throughput'] / old['throughput'] if old['throughput'] else float('inf')
+        print(f'{name:<22} throughput x{speedup:.2f}  p99 {old["p99_ms"]:.3f}ms -> {result["p99_ms"]:.3f}ms')
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the RoleRequest offline benchmarks.')
+    parser.add_argument('--guilds', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=500000)
+    parser.add_argument('--engine', choices=['tinydb', 'sqlite'], default='tinydb')
+    parser.add_argument('--ops', type=int, default=1000, help='operations for read-heavy benchmarks')
+    parser.add_argument('--write-ops', type=int, default=100, help='operations for benchmarks that write')
+    parser.add_argument('--cache-size', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true', help='also report traced peak memory (slower)')
+    parser.add_argument('--compare', metavar='RESULTS', help='earlier results file to compare against')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]: %(message)s', level=logging.WARNING)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(run(args))
+
+    if args.compare: compare(results, args.compare)
+
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S') + '.json')
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': dict(vars(args), commit=git_commit(), python=platform.python_version(),
+                    time=datetime.datetime.utcnow().isoformat()),
+                'results': results
+            }, f, indent=2)
+
+        print(f'\nSaved results to {path}')
+
+if __name__ == '__main__':
+    main()
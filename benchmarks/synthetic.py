@@ -0,0 +1,65 @@
+import json
+import random
+import time
+
+from .fakes import FakeGuild, snowflake
+
+# Status mix of stored requests; expired requests are deleted, so they never show up here
+STATUS_WEIGHTS = { 'pending': 10, 'approved': 50, 'denied': 20, 'cancelled': 20 }
+
+def generate(path, *, guilds=10000, requests=500000, roles_per_guild=(5, 50), users_per_guild=(10, 2000),
+    extra_roles=(0, 200), seed=0):
+    '''
+    Writes a synthetic TinyDB database (db.json format) to path and returns the matching fake guilds
+
+    Requests are spread over guilds with a long tail, so a few guilds are much busier than the rest, and created
+    at random times over the last 48 hours, so about half of the pending requests are already due to expire.
+    '''
+    rng = random.Random(seed)
+    now = time.time()
+
+    weights = [1 / (i + 1) for i in range(guilds)]
+    total = sum(weights)
+    request_counts = [int(requests * w / total) for w in weights]
+    rng.shuffle(request_counts)
+
+    statuses = list(STATUS_WEIGHTS)
+    status_weights = list(STATUS_WEIGHTS.values())
+
+    table = {}
+    fakes = []
+
+    for i in range(guilds):
+        guild_id = snowflake()
+        channel_id = snowflake()
+        role_ids = [snowflake() for _ in range(rng.randint(*roles_per_guild))]
+        other_roles = [snowflake() for _ in range(rng.randint(*extra_roles))]
+        users = [snowflake() for _ in range(rng.randint(*users_per_guild))]
+
+        doc = {
+            'id': guild_id,
+            'requests_opts': { 'channel': channel_id, 'hidejoins': rng.random() < 0.3, 'ratelimit': True },
+            'requests': {},
+            'roles': { str(r): { 'type': 'limited' if rng.random() < 0.4 else 'open' } for r in role_ids }
+        }
+
+        for _ in range(request_counts[i]):
+            doc['requests'][str(snowflake())] = {
+                'channel': channel_id,
+                'created': now - rng.random() * 48 * 60 * 60,
+                'role': rng.choice(role_ids),
+                'status': rng.choices(statuses, status_weights)[0],
+                'user': rng.choice(users)
+            }
+
+        table[str(i + 1)] = doc
+
+        guild = FakeGuild(guild_id, role_ids + other_roles, [channel_id])
+        guild.users = users
+        guild.requestable = role_ids
+        fakes.append(guild)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({ '_default': table }, f)
+
+    return fakes
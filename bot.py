@@ -1,11 +1,25 @@
+import asyncio
+import json
 import logging
+import os
+import resource
+import time
 
 import discord
 from discord.ext import commands
-from tinydb import TinyDB
 
+from asyncstorage import AsyncStorage
+from cache import GuildCache
 import config
+from consts import *
 import datetime
+from deletions import DeletionBatcher
+from journal import JournaledStorage
+from members import MemberCache
+import metrics
+import outbound
+from reconcile import reconcile
+from storage import openStorage
 import utils
 
 LOG_FORMAT = '[%(asctime)s] [%(levelname)s]: %(message)s'
@@ -16,32 +30,136 @@ if config.prefix:
 else:
     prefix = commands.when_mentioned
 
-bot = commands.Bot(command_prefix=prefix, case_insensitive=True, 
-    allowed_mentions=discord.AllowedMentions(everyone=False, users=False, roles=False)) 
+# Sharding is set up by launcher.py through the environment, or by config.py for a single sharded process
+shard_count = os.environ.get('ROLEREQUEST_SHARD_COUNT', getattr(config, 'shard_count', None))
+shard_ids = os.environ.get('ROLEREQUEST_SHARD_IDS', getattr(config, 'shard_ids', None))
+cluster = os.environ.get('ROLEREQUEST_CLUSTER')
 
-db = TinyDB('db.json')
+bot_options = dict(command_prefix=prefix, case_insensitive=True, 
+    allowed_mentions=discord.AllowedMentions(everyone=False, users=False, roles=False))
+
+# Low-memory mode keeps no members, messages or voice states from the gateway; the few members the bot needs are
+# looked up through bot.member_cache, falling back to REST
+if getattr(config, 'low_memory', False):
+    intents = discord.Intents.default()
+    intents.members = intents.presences = intents.voice_states = intents.typing = False
+
+    bot_options.update(intents=intents, member_cache_flags=discord.MemberCacheFlags.none(),
+        chunk_guilds_at_startup=False, max_messages=None)
+
+if shard_count:
+    if isinstance(shard_ids, str): shard_ids = [int(i) for i in shard_ids.split(',')]
+    bot = commands.AutoShardedBot(shard_count=int(shard_count), shard_ids=shard_ids, **bot_options)
+else:
+    bot = commands.Bot(**bot_options)
+
+db = openStorage(getattr(config, 'storage', 'tinydb'), getattr(config, 'storage_path', None))
+
+if getattr(config, 'journal', False):
+    db = JournaledStorage(db, f'db.journal.{cluster}' if cluster else 'db.journal', interval=getattr(config, 'journal_interval', 0.5),
+        max_ops=getattr(config, 'journal_max_ops', 100))
+
+# Storage is only accessed through worker threads, so disk I/O never blocks the event loop
+db = AsyncStorage(db, readers=getattr(config, 'storage_readers', 4))
 
 class Core(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         bot.db = db
+        bot.metrics = metrics.Metrics(enabled=getattr(config, 'metrics', False))
+        bot.guild_cache = GuildCache(max_size=getattr(config, 'guild_cache_size', None))
+        bot.member_cache = MemberCache(max_size=getattr(config, 'member_cache_size', 1000),
+            ttl=getattr(config, 'member_cache_ttl', 300))
+        bot.outbound = outbound.OutboundScheduler(workers=getattr(config, 'outbound_workers', 8),
+            route_limits={ 'dm': 2, 'roles': 4 }, max_pending={ outbound.EMBED: 500, outbound.DM: 200 })
+        bot.outbound.start(bot.loop)
+        bot.deletions = DeletionBatcher(bot.outbound)
         bot.git_hash = utils.getGitInfo(initialize=True)
         bot.start_time = datetime.datetime.utcnow()
+        bot.reconciled = asyncio.Event() # Set once the startup reconciliation has run
+
+        if isinstance(db.storage, JournaledStorage):
+            bot.loop.create_task(db.storage.commit_loop(flush=db.flush))
+
+        bot.metrics.register('guild_cache', bot.guild_cache.stats)
+        bot.metrics.register('member_cache', bot.member_cache.stats)
+        bot.metrics.register('outbound', bot.outbound.stats)
+        bot.metrics.register('deletions', bot.deletions.stats)
+        bot.metrics.register('storage', db.stats)
+        if isinstance(db.storage, JournaledStorage): bot.metrics.register('journal', db.storage.stats)
+
+        if bot.metrics.enabled:
+            bot.lag_monitor = metrics.LagMonitor(bot.metrics, EVENT_LOOP_LAG_INTERVAL)
+            bot.metrics.register('event_loop', bot.lag_monitor.stats)
+            bot.loop.create_task(bot.lag_monitor.run())
+
+        bot.metrics.register('process', self.health)
+        if cluster: bot.loop.create_task(self.health_loop())
+
+        if bot.metrics.enabled and getattr(config, 'metrics_port', None):
+            bot.loop.create_task(metrics.serve(bot.metrics, port=config.metrics_port))
+        if bot.metrics.enabled and getattr(config, 'metrics_file', None):
+            bot.loop.create_task(metrics.write_loop(bot.metrics, config.metrics_file))
+
+    # Health and load of this process, shown in its metrics and reported to launcher.py when running in a cluster
+    def health(self):
+        latencies = dict(bot.latencies) if isinstance(bot, commands.AutoShardedBot) else { bot.shard_id or 0: bot.latency }
+
+        return {
+            'guilds': len(bot.guilds),
+            'ready': int(bot.is_ready()),
+            'shards': { str(shard): { 'latency': latency } for shard, latency in latencies.items() },
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'cpu_seconds': time.process_time()
+        }
+
+    async def health_loop(self):
+        os.makedirs('cluster', exist_ok=True)
+        path = os.path.join('cluster', f'{cluster}.json')
+
+        while True:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(dict(self.health(), cluster=cluster, pid=os.getpid(), time=time.time(),
+                    shard_ids=bot.shard_ids), f)
+            os.replace(path + '.tmp', path)
+
+            await asyncio.sleep(CLUSTER_HEALTH_INTERVAL)
 
     @commands.Cog.listener()
     async def on_ready(self):
         logging.info('[Bot] Ready')
 
-        for guild in bot.db:
-            if not bot.get_guild(guild['id']):
-                utils.removeGuild(bot, guild['id'])
+        # Only reconcile on the first ready, not after reconnects
+        if bot.reconciled.is_set(): return
+
+        await reconcile(bot)
+        bot.reconciled.set()
+
+        logging.info(f'[Bot] Ready to serve in {(datetime.datetime.utcnow() - bot.start_time).total_seconds():.3f}s')
 
     @commands.Cog.listener()
-    async def on_guild_remove(guild):
-        utils.removeGuild(bot, guild.id)
+    async def on_guild_remove(self, guild):
+        await utils.removeGuild(bot, guild.id)
+
+    async def bot_check_once(self, ctx):
+        ctx.invoked_at = time.perf_counter()
+        return True
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        self.observe_command(ctx, 'success')
+
+    def observe_command(self, ctx, result):
+        if not (bot.metrics.enabled and ctx.command and hasattr(ctx, 'invoked_at')): return
+
+        labels = (('command', ctx.command.qualified_name),)
+        bot.metrics.observe('command_latency', time.perf_counter() - ctx.invoked_at, labels)
+        bot.metrics.inc('commands', labels + (('result', result),))
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
+        self.observe_command(ctx, 'error')
+
         if isinstance(error, commands.errors.CommandInvokeError):
             await utils.cmdFail(ctx, f'Command raised an unexpected exception.')
             raise error
@@ -52,4 +170,6 @@ bot.add_cog(Core(bot))
 bot.load_extension('jishaku')
 bot.load_extension('modules.core')
 bot.load_extension('modules.limited')
-bot.run(config.token)
\ No newline at end of file
+bot.load_extension('modules.rolemenu')
+bot.run(config.token)
+db.close()
\ No newline at end of file
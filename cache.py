@@ -0,0 +1,93 @@
+import collections
+
+MISSING = object()
+
+class GuildCache:
+    '''
+    In-memory cache of guild records (models.GuildRecord) keyed by guild id
+
+    Records are shared with callers, which change them in place and persist the changes with utils.saveGuild.
+    Guilds without a document are cached as None so repeated lookups for them don't hit storage either. If max_size
+    is set, the least recently used guild is evicted once the cache grows past it.
+
+    Data derived from a guild record, such as indexes, can be kept alongside it with derived(); it is dropped
+    whenever the record is replaced, invalidated or evicted.
+    '''
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._docs = collections.OrderedDict()
+        self._derived = {}
+        self.loading = {} # guild id -> Future of the record being loaded from storage, see utils.getGuildRecord
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, guild_id):
+        return guild_id in self._docs
+
+    def get(self, guild_id):
+        doc = self._docs.get(guild_id, MISSING)
+
+        if doc is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if self.max_size: self._docs.move_to_end(guild_id)
+
+        return doc
+
+    # Like get, but doesn't count towards the hit/miss statistics or the eviction order; used for write-through.
+    def peek(self, guild_id):
+        return self._docs.get(guild_id, MISSING)
+
+    def put(self, guild_id, doc):
+        self._docs[guild_id] = doc
+        self._derived.pop(guild_id, None)
+
+        if self.max_size:
+            self._docs.move_to_end(guild_id)
+            while len(self._docs) > self.max_size:
+                evicted, _ = self._docs.popitem(last=False)
+                self._derived.pop(evicted, None)
+                self.evictions += 1
+
+    def invalidate(self, guild_id):
+        self._docs.pop(guild_id, None)
+        self._derived.pop(guild_id, None)
+
+    def clear(self):
+        self._docs.clear()
+        self._derived.clear()
+
+    # Returns the value derived from the cached record under name, building it with build(record) on first use.
+    def derived(self, guild_id, name, build):
+        doc = self._docs.get(guild_id)
+        if doc is None: return None
+
+        derived = self._derived.setdefault(guild_id, {})
+        if name not in derived:
+            derived[name] = build(doc)
+
+        return derived[name]
+
+    # Returns the derived value only if it has already been built
+    def peek_derived(self, guild_id, name):
+        return self._derived.get(guild_id, {}).get(name)
+
+    def drop_derived(self, guild_id, name):
+        self._derived.get(guild_id, {}).pop(name, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            'size': len(self._docs),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,74 @@
+'''
+Message components (buttons) and interaction responses
+
+discord.py 1.x has no API for either, so messages with components are sent and edited through the bot's HTTP client
+directly, and component interactions are read from the raw INTERACTION_CREATE gateway event.
+'''
+import re
+
+from discord.http import Route
+
+# Component types and button styles
+ACTION_ROW = 1
+BUTTON = 2
+SECONDARY = 2
+SUCCESS = 3
+DANGER = 4
+
+# Interaction types and response types
+MESSAGE_COMPONENT = 3
+CHANNEL_MESSAGE = 4
+DEFERRED_UPDATE_MESSAGE = 6
+
+EPHEMERAL = 1 << 6
+
+CUSTOM_EMOJI = re.compile(r'<?(a?):?(\w+):(\d+)>?')
+
+# Converts an emoji as written in config.py ('name:id', '<:name:id>' or a unicode emoji) to a component emoji
+def partialEmoji(emoji):
+    match = CUSTOM_EMOJI.fullmatch(emoji)
+    if not match: return { 'name': emoji }
+
+    return { 'name': match.group(2), 'id': match.group(3), 'animated': bool(match.group(1)) }
+
+def button(custom_id, label, style, emoji=None):
+    component = { 'type': BUTTON, 'custom_id': custom_id, 'label': label, 'style': style }
+    if emoji: component['emoji'] = partialEmoji(emoji)
+    return component
+
+def actionRow(*components):
+    return { 'type': ACTION_ROW, 'components': list(components) }
+
+# Returns the raw message data, of which usually only the id is needed
+async def sendMessage(http, channel_id, *, embed, components):
+    route = Route('POST', '/channels/{channel_id}/messages', channel_id=channel_id)
+    return await http.request(route, json={ 'embed': embed.to_dict(), 'components': components })
+
+# Editing with no components removes any buttons from the message
+async def editMessage(http, channel_id, message_id, *, embed, components=()):
+    route = Route('PATCH', '/channels/{channel_id}/messages/{message_id}', channel_id=channel_id,
+        message_id=message_id)
+    return await http.request(route, json={ 'embed': embed.to_dict(), 'components': list(components) })
+
+# Responds to an interaction; interactions that aren't responded to within 3 seconds fail for the user
+async def respond(http, interaction, response_type, data=None):
+    route = Route('POST', '/interactions/{interaction_id}/{interaction_token}/callback',
+        interaction_id=interaction['id'], interaction_token=interaction['token'])
+
+    payload = { 'type': response_type }
+    if data is not None: payload['data'] = data
+    return await http.request(route, json=payload)
+
+# Acknowledges the interaction without changing the message yet; the message is edited later with editMessage
+async def deferUpdate(http, interaction):
+    return await respond(http, interaction, DEFERRED_UPDATE_MESSAGE)
+
+# Replies with a message only the user who used the component can see
+async def replyEphemeral(http, interaction, content):
+    return await respond(http, interaction, CHANNEL_MESSAGE, { 'content': content, 'flags': EPHEMERAL })
+
+# Sends a message only the user can see, for interactions that have already been responded to, e.g. deferred
+async def followupEphemeral(http, interaction, content):
+    route = Route('POST', '/webhooks/{application_id}/{interaction_token}',
+        application_id=interaction['application_id'], interaction_token=interaction['token'])
+    return await http.request(route, json={ 'content': content, 'flags': EPHEMERAL })
@@ -7,17 +7,48 @@ GIT_REPO_URL = 'https://github.com/7bitlyrus/RoleRequest'
 GIT_COMMIT_BASE = GIT_REPO_URL + '/commit/'
 GIT_COMPARE_BASE = GIT_REPO_URL + '/compare/'
 
-LIMITED_RATELIMIT_SCORE_MAX = 21
+LIMITED_REQUEST_LIFETIME = 24 * 60 * 60 # Seconds before a request expires
+
+LIMITED_RETENTION = 24 # Hours resolved requests are kept before being archived, configurable per guild
+LIMITED_RETENTION_INTERVAL = 10 * 60 # Seconds between retention passes
+LIMITED_RETENTION_CHUNK = 50 # Guilds processed before yielding to the event loop
+LIMITED_EXPIRY_CHUNK = 50 # Expiring requests processed before yielding to the event loop
+LIMITED_HISTORY_LIMIT = 100
+LIMITED_BULK_CONCURRENCY = 5 # Requesters whose requests are resolved at once by the bulk approve/deny commands
+LIMITED_BULK_PROGRESS_INTERVAL = 3 # Seconds between progress updates of the bulk approve/deny commands
+
+LIMITED_RATELIMIT_SCORE_MAX = 21 # Defaults, configurable per guild
+LIMITED_RATELIMIT_WINDOW = 24 # Hours
+LIMITED_RATELIMIT_WINDOW_MAX = 7 * 24
 LIMITED_RATELIMIT_SCORES = {
     'pending': 3,
     'cancelled': 5,
     'denied': 7
 }
 
+CLUSTER_HEALTH_INTERVAL = 15 # Seconds between cluster process health reports
+CLUSTER_RESTART_DELAY = 5 # Seconds before restarting a cluster process that exited
+
+DELETION_BATCH_WINDOW = 1 # Seconds a channel's due deletions are collected before they're deleted together
+DELETION_BULK_MAX = 100 # Messages per bulk delete, Discord's limit
+DELETION_BULK_MAX_AGE = 14 * 24 * 60 * 60 - 60 # Seconds; older messages can't be bulk deleted
+
+ROLEMENU_MAX_ENTRIES = 20 # Roles per menu, Discord's limit of distinct reactions on a message
+ROLEMENU_COALESCE_WINDOW = 1 # Seconds a member's role menu changes are collected before they're applied together
+ROLEMENU_SETTLE = 10 # Seconds applied role changes are assumed to be missing from the member's roles in gateway events
+
+EXPORT_CHUNK = 500 # Records written by the export command per storage worker call
+STORAGE_READ_CHUNK = 100 # Guild documents read per storage worker call when iterating the database
+
+EVENT_LOOP_LAG_INTERVAL = 0.5 # Seconds between event loop lag samples
+
 EMBED_LENGTH_LIMITS = {
     'overall': 6000,
     'description': 2048,
     'field_values': 1024
 }
 
+PAGINATOR_EMOJIS = ['\u25C0\uFE0F', '\u25B6\uFE0F'] # Previous, next
+PAGINATOR_TIMEOUT = 120 # Seconds
+
 GIT_REPO_REGEX = r'(?:https?://)?(?:\w+@)?([^:/\s]+)[:|/]([^/\s]+)/([^/.\s]+)(?:.git)?'
\ No newline at end of file
@@ -0,0 +1,99 @@
+import asyncio
+import datetime
+import logging
+
+import discord
+
+from consts import *
+import outbound
+
+class DeletionBatcher:
+    '''
+    Deletes messages after a delay, batched per channel
+
+    Messages that come due in the same channel within window seconds of the first one are deleted together, with a
+    single bulk delete per DELETION_BULK_MAX messages instead of a call each. Bulk deletes need the Manage Messages
+    permission and only work on messages less than 14 days old, so messages that don't qualify, and lone messages,
+    are deleted one at a time. Deletions go through the outbound scheduler's 'delete' route.
+    '''
+    def __init__(self, scheduler, *, window=DELETION_BATCH_WINDOW):
+        self.scheduler = scheduler
+        self.window = window
+        self.pending = {} # channel id -> (channel, [message id, ...]) waiting for the window to close
+
+        self.scheduled = 0
+        self.bulk_calls = 0
+        self.bulk_deleted = 0
+        self.single_calls = 0
+        self.failed = 0
+
+    # Deletes the message with message_id from channel after delay seconds
+    def schedule(self, channel, message_id, delay=0):
+        self.scheduled += 1
+        asyncio.get_event_loop().call_later(delay, self._due, channel, message_id)
+
+    def _due(self, channel, message_id):
+        entry = self.pending.get(channel.id)
+
+        if entry is None:
+            entry = self.pending[channel.id] = (channel, [])
+            asyncio.get_event_loop().call_later(self.window, self._close, channel.id)
+
+        entry[1].append(message_id)
+
+    def _close(self, channel_id):
+        channel, message_ids = self.pending.pop(channel_id)
+        asyncio.ensure_future(self.delete(channel, message_ids)).add_done_callback(self._log_failure)
+
+    async def delete(self, channel, message_ids):
+        oldest = discord.utils.time_snowflake(datetime.datetime.utcnow() -
+            datetime.timedelta(seconds=DELETION_BULK_MAX_AGE))
+        can_bulk = channel.permissions_for(channel.guild.me).manage_messages
+
+        recent = [message_id for message_id in message_ids if can_bulk and message_id > oldest]
+        single = [message_id for message_id in message_ids if not (can_bulk and message_id > oldest)]
+
+        for i in range(0, len(recent), DELETION_BULK_MAX):
+            chunk = recent[i:i + DELETION_BULK_MAX]
+
+            if len(chunk) == 1:
+                single.extend(chunk)
+                continue
+
+            try:
+                await self.scheduler.call(outbound.EMBED, 'delete',
+                    lambda: channel.delete_messages([discord.Object(message_id) for message_id in chunk]))
+            except discord.HTTPException as e:
+                logging.info(f'[Outbound] Bulk delete of {len(chunk)} messages in {channel.id} failed, deleting ' +
+                    f'them one at a time: {e}')
+                single.extend(chunk)
+            else:
+                self.bulk_calls += 1
+                self.bulk_deleted += len(chunk)
+
+        await asyncio.gather(*(self._delete_one(channel, message_id) for message_id in single))
+
+    async def _delete_one(self, channel, message_id):
+        self.single_calls += 1
+
+        try:
+            await self.scheduler.call(outbound.EMBED, 'delete', lambda: channel.get_partial_message(message_id).delete())
+        except discord.NotFound:
+            pass # Already deleted
+        except discord.HTTPException:
+            self.failed += 1
+
+    def stats(self):
+        return {
+            'scheduled': self.scheduled,
+            'pending': sum(len(message_ids) for _, message_ids in self.pending.values()),
+            'bulk_calls': self.bulk_calls,
+            'bulk_deleted': self.bulk_deleted,
+            'single_calls': self.single_calls,
+            'failed': self.failed,
+            'calls_saved': self.bulk_deleted - self.bulk_calls
+        }
+
+    def _log_failure(self, task):
+        if not task.cancelled() and task.exception():
+            logging.info(f'[Outbound] Batched delete failed: {task.exception()}')
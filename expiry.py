@@ -0,0 +1,53 @@
+import heapq
+
+class ExpiryHeap:
+    '''
+    Min-heap of limited request deadlines
+
+    Entries are (deadline, guild id, message id). Rescheduling or discarding a request doesn't search the heap; the
+    current deadline of each request is kept in a dict and stale heap entries are skipped when they reach the top.
+    '''
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, message_id):
+        return int(message_id) in self._deadlines
+
+    def push(self, guild_id, message_id, deadline):
+        message_id = int(message_id)
+
+        self._deadlines[message_id] = deadline
+        heapq.heappush(self._heap, (deadline, guild_id, message_id))
+
+    def discard(self, message_id):
+        self._deadlines.pop(int(message_id), None)
+
+    def clear(self):
+        self._heap.clear()
+        self._deadlines.clear()
+
+    def next_deadline(self):
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    # Pops every request due at or before now, grouped by guild id: { guild_id: [message_id, ...] }
+    def pop_due(self, now):
+        due = {}
+
+        while True:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now: break
+
+            deadline, guild_id, message_id = heapq.heappop(self._heap)
+            del self._deadlines[message_id]
+            due.setdefault(guild_id, []).append(message_id)
+
+        return due
+
+    def _drop_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
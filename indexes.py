@@ -0,0 +1,95 @@
+class RequestIndex:
+    '''
+    Secondary indexes over the limited requests of a single guild record
+
+    by_message maps message id -> request, latest maps (user id, role id) -> message id of the user's most recent
+    request for the role, and by_user maps user id -> message ids of the user's requests in creation order. Request
+    objects are shared with the guild record, so status changes are seen without reindexing; adding and removing
+    requests has to be mirrored with add and remove.
+    '''
+    __slots__ = ('by_message', 'latest', 'by_user')
+
+    def __init__(self, record):
+        self.by_message = {}
+        self.latest = {}
+        self.by_user = {}
+
+        for message_id, request in record.requests():
+            self.add(message_id, request)
+
+    def __contains__(self, message_id):
+        return int(message_id) in self.by_message
+
+    def add(self, message_id, request):
+        message_id = int(message_id)
+
+        self.by_message[message_id] = request
+        self.by_user.setdefault(request.user, {})[message_id] = None
+
+        key = (request.user, request.role)
+        if message_id >= self.latest.get(key, 0):
+            self.latest[key] = message_id
+
+    def remove(self, message_id):
+        message_id = int(message_id)
+
+        request = self.by_message.pop(message_id, None)
+        if not request: return
+
+        user_requests = self.by_user[request.user]
+        del user_requests[message_id]
+        if not user_requests: del self.by_user[request.user]
+
+        # Fall back to the user's previous request for the role, if any
+        key = (request.user, request.role)
+        if self.latest.get(key) == message_id:
+            previous = [m for m in user_requests if self.by_message[m].role == request.role]
+
+            if previous:
+                self.latest[key] = previous[-1]
+            else:
+                del self.latest[key]
+
+    def get(self, message_id):
+        return self.by_message.get(int(message_id))
+
+    # Returns (message id, request) of the user's most recent request for the role, or (None, None)
+    def latest_request(self, user_id, role_id):
+        message_id = self.latest.get((user_id, role_id))
+        return (message_id, self.by_message[message_id]) if message_id else (None, None)
+
+    def user_requests(self, user_id):
+        return [self.by_message[m] for m in self.by_user.get(user_id, ())]
+
+class RoleIndex:
+    '''
+    Requestable roles of a single guild record, as int role id -> role type
+
+    The types are the guild record's roles. The requestable roles in display order (highest first) are resolved from
+    the guild's roles on first use and kept until invalidate_order is called, i.e. when a requestable role is added
+    or removed or a gateway role event arrives.
+    '''
+    __slots__ = ('types', '_ordered')
+
+    def __init__(self, record):
+        self.types = record.roles
+        self._ordered = None
+
+    def __contains__(self, role_id):
+        return role_id in self.types
+
+    def __len__(self):
+        return len(self.types)
+
+    def get(self, role_id):
+        return self.types.get(role_id)
+
+    def ordered(self, guild):
+        if self._ordered is None:
+            roles = filter(None, map(guild.get_role, self.types))
+            self._ordered = sorted(roles, key=lambda r: r.position, reverse=True)
+
+        return self._ordered
+
+    def invalidate_order(self):
+        self._ordered = None
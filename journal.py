@@ -0,0 +1,182 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+
+from storage import Storage
+
+class JournaledStorage(Storage):
+    '''
+    Write-behind layer in front of another storage engine
+
+    Mutations are appended to an append-only journal file and queued in memory, where later writes to the same key
+    replace earlier ones. The queue is group-committed to the underlying engine by commit_loop every interval
+    seconds, or as soon as max_ops operations are queued, after which the journal is truncated. Anything left in the
+    journal after a crash is replayed into the engine when the storage is opened again.
+
+    Reads of a guild with queued writes, and iteration over all guilds, commit the queue first so they never see
+    stale data. Behind asyncstorage.AsyncStorage, every call including commits runs on its writer thread.
+    '''
+    def __init__(self, storage, path='db.journal', *, interval=0.5, max_ops=100):
+        self.storage = storage
+        self.path = path
+        self.interval = interval
+        self.max_ops = max_ops
+
+        self.pending = collections.OrderedDict()
+        self.pending_guilds = collections.Counter()
+        self.full = asyncio.Event()
+        self.loop = None # Set by commit_loop, so a full queue can wake it from the storage writer thread
+
+        self.commits = 0
+        self.committed_ops = 0
+        self.coalesced_ops = 0
+        self.max_batch = 0
+        self.commit_time = 0.0
+        self.last_commit_time = 0.0
+
+        self.replay()
+        self.journal = open(path, 'a', encoding='utf-8')
+
+    def replay(self):
+        if not os.path.exists(self.path): return
+
+        ops = []
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    ops.append(json.loads(line))
+                except ValueError:
+                    break # Partially written last line
+
+        if ops:
+            self.storage.apply(ops)
+            logging.warning(f'[Storage] Replayed {len(ops)} uncommitted operations from {self.path}')
+
+        os.remove(self.path)
+
+    def get(self, guild_id):
+        if self.pending_guilds[guild_id]: self.flush()
+        return self.storage.get(guild_id)
+
+    def contains(self, guild_id):
+        if self.pending_guilds[guild_id]: self.flush()
+        return self.storage.contains(guild_id)
+
+    def insert(self, doc):
+        self._append(('insert', doc), (doc['id'], None))
+        return doc['id']
+
+    def set(self, guild_id, key, val):
+        self._append(('set', guild_id, key, val), (guild_id, key))
+
+    def delete(self, guild_id, key):
+        self._append(('delete', guild_id, key), (guild_id, key))
+
+    def remove(self, guild_id):
+        self._append(('remove', guild_id), (guild_id, None))
+
+    def apply(self, ops):
+        for op in ops:
+            getattr(self, op[0])(*op[1:])
+
+    def __iter__(self):
+        self.flush()
+        return iter(self.storage)
+
+    def docs(self, owns=None):
+        self.flush()
+        return self.storage.docs(owns)
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+        self.storage.close()
+
+    # Commits every queued operation to the underlying engine in a single batch
+    def flush(self):
+        if not self.pending: return
+
+        ops = list(self.pending.values())
+        start = time.perf_counter()
+
+        try:
+            self.storage.apply(ops)
+        except:
+            # Don't let a single bad operation wedge the queue; apply the rest one by one
+            logging.exception('[Storage] Group commit failed, committing operations individually')
+            for op in ops:
+                try:
+                    self.storage.apply([op])
+                except:
+                    logging.exception(f'[Storage] Dropped operation: {op}')
+
+        self.journal.seek(0)
+        self.journal.truncate()
+
+        elapsed = time.perf_counter() - start
+        self.pending.clear()
+        self.pending_guilds.clear()
+
+        self.commits += 1
+        self.committed_ops += len(ops)
+        self.max_batch = max(self.max_batch, len(ops))
+        self.commit_time += elapsed
+        self.last_commit_time = elapsed
+
+    # flush is a coroutine function committing the queue, e.g. AsyncStorage.flush to commit off the event loop
+    async def commit_loop(self, flush=None):
+        self.loop = asyncio.get_event_loop()
+
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.full.clear()
+            if flush:
+                await flush()
+            else:
+                self.flush()
+
+    def stats(self):
+        return {
+            'pending_ops': len(self.pending),
+            'commits': self.commits,
+            'committed_ops': self.committed_ops,
+            'coalesced_ops': self.coalesced_ops,
+            'avg_batch': self.committed_ops / self.commits if self.commits else 0.0,
+            'max_batch': self.max_batch,
+            'avg_commit_time': self.commit_time / self.commits if self.commits else 0.0,
+            'last_commit_time': self.last_commit_time
+        }
+
+    # slot is (guild_id, key); a key of None covers the whole guild document
+    def _append(self, op, slot):
+        line = json.dumps(op)
+        self.journal.write(line + '\n')
+        self.journal.flush()
+
+        # Queue the serialized copy, since callers go on to modify the cached documents that op may reference
+        op = json.loads(line)
+
+        guild_id, key = slot
+
+        # Drop queued writes that this one overwrites: the same key, or anything nested under it
+        for queued in [s for s in self.pending if s[0] == guild_id and
+            (key is None or s[1] == key or (s[1] is not None and s[1].startswith(key + '.')))]:
+            del self.pending[queued]
+            self.pending_guilds[guild_id] -= 1
+            self.coalesced_ops += 1
+
+        self.pending[slot] = op
+        self.pending_guilds[guild_id] += 1
+
+        if len(self.pending) >= self.max_ops:
+            if self.loop:
+                self.loop.call_soon_threadsafe(self.full.set)
+            else:
+                self.full.set()
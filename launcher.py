@@ -0,0 +1,108 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import config
+from consts import *
+from storage import openStorage
+
+LOG_FORMAT = '[%(asctime)s] [%(levelname)s]: %(message)s'
+logging.basicConfig(format = LOG_FORMAT, level = logging.INFO)
+
+# Splits shards 0..shard_count-1 into contiguous ranges, one per process
+def shardRanges(shard_count, processes):
+    per_process, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+
+    for i in range(processes):
+        end = start + per_process + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+
+    return [r for r in ranges if r]
+
+class Cluster:
+    '''Runs bot.py once per shard range and restarts processes that exit'''
+    def __init__(self, shard_count, processes):
+        self.shard_count = shard_count
+        self.ranges = shardRanges(shard_count, processes)
+        self.processes = {}
+        self.exited = {}
+
+    def spawn(self, cluster):
+        env = dict(os.environ,
+            ROLEREQUEST_CLUSTER=str(cluster),
+            ROLEREQUEST_SHARD_COUNT=str(self.shard_count),
+            ROLEREQUEST_SHARD_IDS=','.join(map(str, self.ranges[cluster])))
+
+        self.processes[cluster] = subprocess.Popen([sys.executable, 'bot.py'], env=env)
+        logging.info(f'[Cluster] Started process {cluster} (pid {self.processes[cluster].pid}) ' +
+            f'for shards {self.ranges[cluster][0]}-{self.ranges[cluster][-1]}')
+
+    def run(self):
+        for cluster in range(len(self.ranges)): self.spawn(cluster)
+        last_report = time.time()
+
+        try:
+            while True:
+                time.sleep(1)
+
+                for cluster, process in self.processes.items():
+                    if process.poll() is None: continue
+
+                    # Restart exited processes after a delay, so a crash loop doesn't spin
+                    if cluster not in self.exited:
+                        logging.warning(f'[Cluster] Process {cluster} exited with code {process.returncode}')
+                        self.exited[cluster] = time.time()
+                    elif time.time() - self.exited[cluster] > CLUSTER_RESTART_DELAY:
+                        del self.exited[cluster]
+                        self.spawn(cluster)
+
+                if time.time() - last_report > CLUSTER_HEALTH_INTERVAL * 4:
+                    self.report()
+                    last_report = time.time()
+        except KeyboardInterrupt:
+            for process in self.processes.values(): process.terminate()
+            for process in self.processes.values(): process.wait()
+
+    # Logs the health each process last reported
+    def report(self):
+        for path in sorted(glob.glob(os.path.join('cluster', '*.json'))):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    health = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            stale = time.time() - health['time'] > CLUSTER_HEALTH_INTERVAL * 3
+            latencies = [s['latency'] for s in health['shards'].values()]
+            latency = max(latencies) * 1000 if latencies else 0
+
+            logging.info(f'[Cluster] Process {health["cluster"]} (pid {health["pid"]}): ' +
+                ('STALE, ' if stale else '') + f'{health["guilds"]} guilds, ' +
+                f'max shard latency {latency:.0f}ms, {health["max_rss_mb"]:.0f}MB, {health["cpu_seconds"]:.0f}s CPU')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs RoleRequest as several processes, each with a range of shards.')
+    parser.add_argument('--shards', type=int, default=getattr(config, 'shard_count', None),
+        help='total number of shards (default: config.shard_count)')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of processes (default: CPUs)')
+    args = parser.parse_args()
+
+    if not args.shards:
+        parser.error('the total number of shards must be set with --shards or config.shard_count')
+
+    # Every process opens the same database, which only the SQLite engine supports
+    if getattr(config, 'storage', 'tinydb') != 'sqlite':
+        parser.error('cluster mode requires storage = \'sqlite\' in config.py')
+
+    # Run any one-shot db.json migration before the processes race to do it
+    openStorage('sqlite', getattr(config, 'storage_path', None)).close()
+
+    Cluster(args.shards, args.processes).run()
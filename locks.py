@@ -0,0 +1,42 @@
+import asyncio
+import contextlib
+
+class KeyedLock:
+    '''
+    An asyncio lock per key, e.g. per limited request message id
+
+    Holders of the same key run one at a time, in the order they asked for the lock, while different keys never wait
+    on each other. Locks are created on first use and dropped as soon as nothing holds or waits for them, so only keys
+    that are in use take up memory.
+    '''
+    def __init__(self):
+        self._locks = {} # key -> [asyncio.Lock, holders and waiters]
+        self.acquired = 0
+        self.contended = 0
+
+    def __len__(self):
+        return len(self._locks)
+
+    def locked(self, key):
+        entry = self._locks.get(key)
+        return bool(entry and entry[0].locked())
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+
+        if entry[0].locked(): self.contended += 1
+        self.acquired += 1
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]: del self._locks[key]
+
+    def stats(self):
+        return { 'held': len(self._locks), 'acquired': self.acquired, 'contended': self.contended }
@@ -0,0 +1,70 @@
+import collections
+import time
+
+from cache import MISSING
+
+class MemberCache:
+    '''
+    Small LRU cache of guild members with a time to live, keyed by (guild id, user id)
+
+    Used in low-memory mode, where the gateway member cache is disabled, to avoid fetching the same requester or
+    moderator over REST repeatedly. Users that aren't in the guild are cached as None, so they aren't refetched
+    either. Entries expire after ttl seconds, as member updates aren't received without the gateway member cache.
+    '''
+    def __init__(self, max_size=1000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.fetches = 0
+        self._members = collections.OrderedDict() # (guild id, user id) -> (expires, member or None)
+
+    def __len__(self):
+        return len(self._members)
+
+    def get(self, guild_id, user_id):
+        entry = self._members.get((guild_id, user_id))
+
+        if entry is None:
+            self.misses += 1
+            return MISSING
+
+        if entry[0] < time.monotonic():
+            del self._members[(guild_id, user_id)]
+            self.expired += 1
+            self.misses += 1
+            return MISSING
+
+        self.hits += 1
+        self._members.move_to_end((guild_id, user_id))
+        return entry[1]
+
+    def put(self, guild_id, user_id, member):
+        self._members[(guild_id, user_id)] = (time.monotonic() + self.ttl, member)
+        self._members.move_to_end((guild_id, user_id))
+
+        while len(self._members) > self.max_size:
+            self._members.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, guild_id, user_id):
+        self._members.pop((guild_id, user_id), None)
+
+    def clear(self):
+        self._members.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            'size': len(self._members),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'fetches': self.fetches,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
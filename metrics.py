@@ -0,0 +1,196 @@
+import asyncio
+import collections
+import functools
+import logging
+import os
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1) # Last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound: break
+        else:
+            i = len(LATENCY_BUCKETS)
+
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    # Estimated from the bucket bounds, so only as precise as LATENCY_BUCKETS
+    def quantile(self, q):
+        if not self.count: return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float('inf')
+
+class Metrics:
+    '''
+    Counters and latency histograms for the bot's hot paths
+
+    Components that already keep their own statistics (the guild cache, outbound scheduler, ...) are registered as
+    collectors, functions returning a (possibly nested) dict of numbers that is read when metrics are rendered. When
+    disabled, observe and inc return immediately and timed functions are called directly.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = collections.Counter()  # (name, labels) -> value
+        self.histograms = {}                   # (name, labels) -> Histogram
+        self.collectors = {}
+        self.start_time = time.time()
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled: return
+        self.counters[(name, labels)] += value
+
+    def observe(self, name, value, labels=()):
+        if not self.enabled: return
+
+        histogram = self.histograms.get((name, labels))
+        if not histogram: histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def register(self, name, collector):
+        self.collectors[name] = collector
+
+    # Histograms matching name, as { labels: Histogram }
+    def histogram_group(self, name):
+        return { labels: h for (n, labels), h in self.histograms.items() if n == name }
+
+    def collect(self):
+        values = {}
+
+        for name, collector in self.collectors.items():
+            try:
+                values[name] = collector()
+            except:
+                logging.exception(f'[Metrics] Collector {name} failed')
+
+        return values
+
+    # Renders every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'rolerequest_{name}_total{_labels(labels)} {value}')
+
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda i: i[0]):
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                seen += count
+                lines.append(f'rolerequest_{name}_seconds_bucket{_labels(labels + (("le", bound),))} {seen}')
+
+            lines.append(f'rolerequest_{name}_seconds_sum{_labels(labels)} {histogram.sum}')
+            lines.append(f'rolerequest_{name}_seconds_count{_labels(labels)} {histogram.count}')
+
+        for name, value in _flatten(self.collect()):
+            lines.append(f'rolerequest_{name} {value}')
+
+        lines.append(f'rolerequest_uptime_seconds {time.time() - self.start_time}')
+        return '\n'.join(lines) + '\n'
+
+# Serves the rendered metrics over HTTP for Prometheus to scrape; bind to localhost unless it's firewalled
+async def serve(metrics, host='127.0.0.1', port=9100):
+    from aiohttp import web
+
+    async def handler(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f'[Metrics] Serving metrics on http://{host}:{port}/metrics')
+    return runner
+
+# Periodically writes the rendered metrics to a file, e.g. for node_exporter's textfile collector
+async def write_loop(metrics, path, interval=15):
+    while True:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(metrics.render())
+        os.replace(path + '.tmp', path)
+
+        await asyncio.sleep(interval)
+
+class LagMonitor:
+    '''
+    Measures event loop lag, how much later than scheduled a sleeping task wakes up
+
+    Lag is time the loop spent running something that didn't yield, during which gateway heartbeats, commands and
+    every other callback had to wait. Samples are observed in the event_loop_lag histogram.
+    '''
+    def __init__(self, metrics, interval=0.5):
+        self.metrics = metrics
+        self.interval = interval
+        self.last = 0.0
+        self.max = 0.0
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+
+            self.last = max(0.0, loop.time() - start - self.interval)
+            self.max = max(self.max, self.last)
+            self.metrics.observe('event_loop_lag', self.last)
+
+    def stats(self):
+        return { 'lag_last_seconds': self.last, 'lag_max_seconds': self.max }
+
+# Decorator timing a helper whose first argument is the bot, e.g. utils.getGuildRecord; coroutine functions are
+# timed until they return, including the time spent waiting on storage
+def timed(name):
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(bot, *args, **kwargs):
+                if not bot.metrics.enabled: return await func(bot, *args, **kwargs)
+
+                start = time.perf_counter()
+                try:
+                    return await func(bot, *args, **kwargs)
+                finally:
+                    bot.metrics.observe('helper_latency', time.perf_counter() - start, (('helper', name),))
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(bot, *args, **kwargs):
+            if not bot.metrics.enabled: return func(bot, *args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return func(bot, *args, **kwargs)
+            finally:
+                bot.metrics.observe('helper_latency', time.perf_counter() - start, (('helper', name),))
+        return wrapper
+    return decorator
+
+def _labels(labels):
+    if not labels: return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+def _flatten(values, prefix=''):
+    for key, value in values.items():
+        name = f'{prefix}{key}'
+
+        if isinstance(value, dict):
+            yield from _flatten(value, name + '_')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
@@ -0,0 +1,244 @@
+import enum
+
+from consts import *
+
+class Status(str, enum.Enum):
+    '''Limited request status; compares and hashes like its string value, which is what storage holds'''
+    PENDING = 'pending'
+    APPROVED = 'approved'
+    DENIED = 'denied'
+    CANCELLED = 'cancelled'
+    EXPIRED = 'expired'
+
+    def __str__(self):
+        return self.value
+
+    # Whether a request with this status can move to status; see TRANSITIONS
+    def can_become(self, status):
+        return status in TRANSITIONS[self]
+
+# Statuses a request can move to from each status. Only pending requests are resolved, and only once; expired
+# requests are archived rather than kept with their new status.
+TRANSITIONS = {
+    Status.PENDING: frozenset({ Status.APPROVED, Status.DENIED, Status.CANCELLED, Status.EXPIRED }),
+    Status.APPROVED: frozenset(),
+    Status.DENIED: frozenset(),
+    Status.CANCELLED: frozenset(),
+    Status.EXPIRED: frozenset()
+}
+
+def _encode(value):
+    return value.value if isinstance(value, Status) else value
+
+class Record:
+    '''
+    Base of the typed parts of a guild record
+
+    Assigning to one of FIELDS marks the field dirty and registers the record with its owning GuildRecord, which
+    turns dirty fields into storage operations when it is committed. Values loaded from storage are set with _load,
+    which doesn't mark anything.
+    '''
+    __slots__ = ('_dirty', '_owner')
+    FIELDS = ()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+
+        if name in self.FIELDS:
+            if self._dirty is None:
+                object.__setattr__(self, '_dirty', set())
+                if self._owner: self._owner._dirty_records.add(self)
+            self._dirty.add(name)
+
+    def _load(self, owner, values, extra):
+        object.__setattr__(self, '_dirty', None)
+        object.__setattr__(self, '_owner', owner)
+        object.__setattr__(self, 'extra', extra or None)
+
+        for name in self.FIELDS:
+            object.__setattr__(self, name, values[name])
+
+    # The GuildRecord this record belongs to, which utils.saveGuild persists its changes through
+    @property
+    def owner(self):
+        return self._owner
+
+    # Returns the changed fields as { field: value } and marks the record clean
+    def changes(self):
+        dirty = self._dirty or ()
+        object.__setattr__(self, '_dirty', None)
+        return { name: _encode(getattr(self, name)) for name in dirty }
+
+    def to_dict(self):
+        data = dict(self.extra or {})
+        data.update((name, _encode(getattr(self, name))) for name in self.FIELDS)
+        return data
+
+class GuildOptions(Record):
+    '''A guild's requests_opts; options that were added later default to their constants'''
+    __slots__ = ('channel', 'hidejoins', 'ratelimit', 'ratelimit_max', 'ratelimit_window', 'retention', 'extra')
+    FIELDS = ('channel', 'hidejoins', 'ratelimit', 'ratelimit_max', 'ratelimit_window', 'retention')
+
+    DEFAULTS = {
+        'channel': None,
+        'hidejoins': False,
+        'ratelimit': True,
+        'ratelimit_max': LIMITED_RATELIMIT_SCORE_MAX,
+        'ratelimit_window': LIMITED_RATELIMIT_WINDOW,
+        'retention': LIMITED_RETENTION
+    }
+
+    @classmethod
+    def from_dict(cls, data, owner=None):
+        options = cls.__new__(cls)
+        options._load(owner, dict(cls.DEFAULTS, **data), { k: v for k, v in data.items() if k not in cls.FIELDS })
+        return options
+
+class Request(Record):
+    '''A limited request, keyed by the id of the message it was posted as'''
+    __slots__ = ('message_id', 'channel', 'created', 'role', 'status', 'user', 'buttons', 'extra')
+    FIELDS = ('channel', 'created', 'role', 'status', 'user', 'buttons')
+
+    def __init__(self, message_id, *, channel, created, role, user, status=Status.PENDING, buttons=False):
+        self._load(None, { 'channel': channel, 'created': created, 'role': role, 'status': status, 'user': user,
+            'buttons': buttons }, None)
+        object.__setattr__(self, 'message_id', message_id)
+
+    @classmethod
+    def from_dict(cls, message_id, data, owner=None):
+        request = cls.__new__(cls)
+        request._load(owner, dict(data, status=Status(data['status']), buttons=data.get('buttons', False)),
+            { k: v for k, v in data.items() if k not in cls.FIELDS })
+        object.__setattr__(request, 'message_id', message_id)
+        return request
+
+    def to_dict(self):
+        data = super().to_dict()
+        if not data['buttons']: del data['buttons'] # Only requests posted with buttons carry the flag
+        return data
+
+class GuildRecord:
+    '''
+    Typed view of a guild document, as cached in bot.guild_cache
+
+    Requestable roles are kept as int role id -> role type, role menus as int message id -> menu, and limited requests
+    are decoded into Request objects keyed by int message id the first time they are accessed. Changes are tracked as
+    they are made, through the record's methods for roles, menus and requests and by assigning to option and request
+    fields, and commit() returns only the storage operations for what changed, to be written with utils.saveGuild.
+    '''
+    __slots__ = ('id', 'options', 'roles', 'menus', 'extra', '_raw_requests', '_requests', '_role_ops', '_menu_ops',
+        '_request_ops', '_dirty_records')
+
+    def __init__(self, doc):
+        self.id = doc['id']
+        self.extra = { k: v for k, v in doc.items()
+            if k not in ('id', 'requests_opts', 'roles', 'rolemenus', 'requests') } or None
+        self.roles = { int(role_id): role['type'] for role_id, role in doc['roles'].items() }
+        self.menus = { int(message_id): menu for message_id, menu in doc.get('rolemenus', {}).items() }
+        self._raw_requests = doc['requests'] # Undecoded requests by str message id
+        self._requests = {}
+        self._role_ops = {}
+        self._menu_ops = {}
+        self._request_ops = {}
+        self._dirty_records = set()
+        self.options = GuildOptions.from_dict(doc['requests_opts'], self)
+
+    def request(self, message_id):
+        message_id = int(message_id)
+        request = self._requests.get(message_id)
+
+        if request is None and self._raw_requests:
+            data = self._raw_requests.pop(str(message_id), None)
+            if data is not None:
+                request = self._requests[message_id] = Request.from_dict(message_id, data, self)
+
+        return request
+
+    # Iterates (message id, Request) in message id order, i.e. creation order, decoding any remaining requests
+    def requests(self):
+        if self._raw_requests:
+            for message_id, data in self._raw_requests.items():
+                self._requests[int(message_id)] = Request.from_dict(int(message_id), data, self)
+            self._raw_requests = None
+            self._requests = dict(sorted(self._requests.items()))
+
+        return list(self._requests.items())
+
+    def add_request(self, request):
+        object.__setattr__(request, '_owner', self)
+        self._requests[request.message_id] = request
+        self._request_ops[request.message_id] = request
+
+    def remove_request(self, message_id):
+        message_id = int(message_id)
+        if self._raw_requests: self._raw_requests.pop(str(message_id), None)
+
+        request = self._requests.pop(message_id, None)
+        if request: self._dirty_records.discard(request)
+        self._request_ops[message_id] = None
+
+    def set_role(self, role_id, role_type):
+        self.roles[role_id] = role_type
+        self._role_ops[role_id] = role_type
+
+    def remove_role(self, role_id):
+        self.roles.pop(role_id, None)
+        self._role_ops[role_id] = None
+
+    # Menus are { 'channel': channel id, 'buttons': bool, 'entries': [{ 'emoji': emoji, 'role': role id }, ...] }, see
+    # modules/rolemenu.py; guilds without menus don't have a rolemenus key
+    def set_menu(self, message_id, menu):
+        self.menus[message_id] = menu
+        self._menu_ops[message_id] = menu
+
+    def remove_menu(self, message_id):
+        self.menus.pop(message_id, None)
+        self._menu_ops[message_id] = None
+
+    # Returns the storage operations for every change since the last commit and marks the record clean
+    def commit(self):
+        ops = []
+
+        for record in self._dirty_records:
+            if record is self.options:
+                ops.extend(('set', self.id, f'requests_opts.{k}', v) for k, v in record.changes().items())
+            elif record.message_id in self._request_ops:
+                record.changes() # Written as a whole below
+            else:
+                ops.extend(('set', self.id, f'requests.{record.message_id}.{k}', v)
+                    for k, v in record.changes().items())
+
+        for role_id, role_type in self._role_ops.items():
+            if role_type is None:
+                ops.append(('delete', self.id, f'roles.{role_id}'))
+            else:
+                ops.append(('set', self.id, f'roles.{role_id}', { 'type': role_type }))
+
+        for message_id, menu in self._menu_ops.items():
+            if menu is None:
+                ops.append(('delete', self.id, f'rolemenus.{message_id}'))
+            else:
+                ops.append(('set', self.id, f'rolemenus.{message_id}', menu))
+
+        for message_id, request in self._request_ops.items():
+            if request is None:
+                ops.append(('delete', self.id, f'requests.{message_id}'))
+            else:
+                ops.append(('set', self.id, f'requests.{message_id}', request.to_dict()))
+
+        self._dirty_records.clear()
+        self._role_ops.clear()
+        self._menu_ops.clear()
+        self._request_ops.clear()
+        return ops
+
+    def to_doc(self):
+        doc = dict(self.extra or {})
+        doc.update({
+            'id': self.id,
+            'requests_opts': self.options.to_dict(),
+            'roles': { str(role_id): { 'type': role_type } for role_id, role_type in self.roles.items() },
+            'requests': { str(message_id): request.to_dict() for message_id, request in self.requests() }
+        })
+        if self.menus: doc['rolemenus'] = { str(message_id): menu for message_id, menu in self.menus.items() }
+        return doc
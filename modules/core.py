@@ -1,4 +1,10 @@
+import collections
+import gzip
+import itertools
+import json
 import logging
+import tempfile
+import time
 import typing
 
 import discord
@@ -6,92 +12,161 @@ from discord import version_info
 from discord.ext import commands
 
 from consts import *
+import outbound
+import transfer
 import utils
 
 class RoleRequest(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.db = bot.db
+        self.list_pages = {} # (guild id, 'requestable' | 'all') -> rendered list pages
 
     @commands.group(name='list', invoke_without_command=True, case_insensitive=True)
     @commands.guild_only()
     async def _list(self, ctx):
         '''Lists all requestable roles'''
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
         has_manage_roles = commands.has_permissions(manage_roles=True)(ctx)
+        footer = f'Use the "{ctx.prefix}list all" command to list all server roles.' if has_manage_roles else None
+        pages = self.list_pages.get((ctx.guild.id, 'requestable'))
 
-        if not (doc and len(doc['roles'])):
-            return await utils.cmdFail(ctx, f'This server does not have any requestable roles.' +
-            f' (Use the `{ctx.prefix}list all` command to list all server roles.)' if has_manage_roles else '')
+        if not pages:
+            index = await utils.getRoleIndex(ctx.bot, ctx.guild)
 
-        roles = list(filter(lambda r: str(r.id) in doc['roles'], ctx.guild.roles)) # Roles in requestable roles
+            if not (index and len(index)):
+                return await utils.cmdFail(ctx, f'This server does not have any requestable roles.' +
+                f' (Use the `{ctx.prefix}list all` command to list all server roles.)' if has_manage_roles else '')
 
-        await self._list_send_embed(ctx, 'Requestable Roles', roles,
-        footer=f'Use the "{ctx.prefix}list all" command to list all server roles.' if has_manage_roles else None)
+            pages = self._list_pages(ctx.guild, index, 'requestable', index.ordered(ctx.guild))
+
+        await utils.sendListEmbed(ctx, 'Requestable Roles', pages=pages, footer=footer)
 
     @_list.command(name='all')
     @commands.has_guild_permissions(manage_roles=True)
     async def _list_all(self, ctx):
         '''Lists all roles in the server'''
-        await self._list_send_embed(ctx, 'All Roles', ctx.guild.roles)
+        pages = self.list_pages.get((ctx.guild.id, 'all'))
+        if not pages:
+            roles = list(reversed(ctx.guild.roles)) # Highest first, like RoleIndex.ordered
+            pages = self._list_pages(ctx.guild, await utils.getRoleIndex(ctx.bot, ctx.guild), 'all', roles)
 
-    # Code common between the 'list' command and its subcommands
-    async def _list_send_embed(self, ctx, title, roles, *, footer=None):
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
-        roles = list(filter(lambda r: not r.is_default(), reversed(roles))) # Reversed without @everyone role
+        await utils.sendListEmbed(ctx, 'All Roles', pages=pages)
 
+    # Renders and caches the pages for the 'list' command and its subcommands
+    def _list_pages(self, guild, index, kind, roles):
         role_list = []
-        raw_list = []
 
         for role in roles:
-            typeStr = doc['roles'][str(role.id)]['type'].title() if (doc and str(role.id) in doc['roles']) else None
-            colorStr = '' if role.color == discord.Colour.default() else f' [{role.color}]'
+            if role.is_default(): continue
 
+            role_type = index.get(role.id) if index else None
+            typeStr = role_type.title() if role_type else None
             role_list.append(f'<@&{role.id}> (`{role.id}`)' + (f' **{typeStr}**' if typeStr else ''))
-            raw_list.append(f'{role.name}{colorStr} ({role.id})' + f' {typeStr}' if typeStr else '')
 
-        await utils.sendListEmbed(ctx, title, role_list, raw_override='\r\n'.join(raw_list), footer=footer)
+        pages = utils.paginateLines(role_list)
+        self.list_pages[(guild.id, kind)] = pages
+        return pages
+
+    # Drops the rendered pages and, when role positions or names may have changed, the requestable role order
+    def _list_invalidate(self, guild_id, *, order=False):
+        self.list_pages.pop((guild_id, 'requestable'), None)
+        self.list_pages.pop((guild_id, 'all'), None)
+
+        index = self.bot.guild_cache.peek_derived(guild_id, 'roles') if order else None
+        if index: index.invalidate_order()
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        self._list_invalidate(role.guild.id, order=True)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        self._list_invalidate(after.guild.id, order=True)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        self._list_invalidate(role.guild.id, order=True)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self._list_invalidate(guild.id)
 
     @commands.command(name='join')
     @commands.guild_only()
     @commands.bot_has_guild_permissions(manage_roles=True)
-    async def _join(self, ctx, role: discord.Role):
+    async def _join(self, ctx, role: discord.Role, *roles: discord.Role):
         '''
         Joins or requests a requestable role
         
-        If the role is a open role, it will be joined. If the role is a limited role, a request is submitted.
+        If the role is a open role, it will be joined. If the role is a limited role, a request is submitted. Several
+        open roles can be joined at once.
         '''
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
+        if roles:
+            return await self._join_many(ctx, [role, *roles])
+
+        index = await utils.getRoleIndex(ctx.bot, ctx.guild)
+        role_type = index.get(role.id) if index else None
 
-        if not (doc and str(role.id) in doc['roles']):
+        if not role_type:
             return await utils.cmdFail(ctx, f'"{role.name}" is not a requestable role.') 
 
+        # Seeds the member cache, so resolving a limited request doesn't have to fetch the requester
+        ctx.bot.member_cache.put(ctx.guild.id, ctx.author.id, ctx.author)
+
         if role in ctx.author.roles:
             return await utils.cmdFail(ctx, f'You already have the role "{role.name}".') 
 
-        if doc['roles'][str(role.id)]['type'] == 'limited':
+        if role_type == 'limited':
             return await self.bot.get_cog('LimitedRequests').request_create(ctx, role)
 
-        await ctx.author.add_roles(role, reason='User joined role via command')
+        await ctx.bot.outbound.call(outbound.ROLE, 'roles',
+            lambda: ctx.author.add_roles(role, reason='User joined role via command'))
         return await utils.cmdSuccess(ctx, f'You have joined the role "{role.name}".')
 
+    # Joins several open roles with a single role update; limited roles have to be requested one at a time
+    async def _join_many(self, ctx, roles):
+        index = await utils.getRoleIndex(ctx.bot, ctx.guild)
+        roles = list(dict.fromkeys(roles))
+
+        not_open = [role for role in roles if not index or index.get(role.id) != 'open']
+        if not_open:
+            return await utils.cmdFail(ctx, ', '.join(f'"{role.name}"' for role in not_open) +
+                f' {"is not an open role" if len(not_open) == 1 else "are not open roles"}. Only open roles can be ' +
+                'joined together, limited roles have to be requested one at a time.')
+
+        missing = [role for role in roles if role not in ctx.author.roles]
+        if not missing:
+            return await utils.cmdFail(ctx, 'You already have all of these roles.')
+
+        # One member edit replaces the author's whole role list, so it's only used when the members intent keeps their
+        # roles current; otherwise a role added since the command was sent would be dropped, and each role gets a call
+        atomic = len(missing) == 1 or not ctx.bot.intents.members
+        await ctx.bot.outbound.call(outbound.ROLE, 'roles', lambda: ctx.author.add_roles(*missing,
+            reason='User joined roles via command', atomic=atomic))
+        return await utils.cmdSuccess(ctx, f'You have joined the role{"s" if len(missing) > 1 else ""} ' +
+            ', '.join(f'"{role.name}"' for role in missing) + '.')
+
     @commands.command(name='leave')
     @commands.guild_only()
     @commands.bot_has_guild_permissions(manage_roles=True)
     async def _leave(self, ctx, role: discord.Role):
         '''Leaves or cancels a request for a requestable role'''
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
+        index = await utils.getRoleIndex(ctx.bot, ctx.guild)
+        role_type = index.get(role.id) if index else None
 
-        if not (doc and str(role.id) in doc['roles']):
+        if not role_type:
            return await utils.cmdFail(ctx, f'"{role.name}" is not a requestable role.') 
 
+        ctx.bot.member_cache.put(ctx.guild.id, ctx.author.id, ctx.author)
+
         if not role in ctx.author.roles:
-            if doc['roles'][str(role.id)]['type'] == 'limited':
+            if role_type == 'limited':
                 return await self.bot.get_cog('LimitedRequests').request_cancel(ctx, role)
             
             return await utils.cmdFail(ctx, f'You do not have the role "{role.name}".') 
 
-        await ctx.author.remove_roles(role, reason='User left role via command')
+        await ctx.bot.outbound.call(outbound.ROLE, 'roles',
+            lambda: ctx.author.remove_roles(role, reason='User left role via command'))
         return await utils.cmdSuccess(ctx, f'You left the role "{role.name}".')
 
     @commands.command(name='role', usage='<role> (add|open|limit(ed)|remove)')
@@ -102,7 +177,8 @@ class RoleRequest(commands.Cog):
         '''Adds, modifies, or removes a requestable role
         
         Adds or removes a role from the server's requestable roles or modifies an existing requestable roles type.'''
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+        index = await utils.getRoleIndex(ctx.bot, ctx.guild)
 
         options = {
             'open': ['open', 'o'],
@@ -124,7 +200,7 @@ class RoleRequest(commands.Cog):
         if role.is_default() or role.managed:
             return await utils.cmdFail(ctx, f'"{role.name}" is not a valid role.')
 
-        role_request_type = None if not (doc and str(role.id) in doc['roles']) else doc['roles'][str(role.id)]['type']
+        role_request_type = index.get(role.id) if index else None
 
         # Role info
         if resolved_option is None:
@@ -148,7 +224,11 @@ class RoleRequest(commands.Cog):
             if not role_request_type:
                 return await utils.cmdFail(ctx, f'"{role.name}" is not a requestable role.') 
 
-            utils.guildKeyDel(ctx.bot, ctx.guild, f'roles.{role.id}')
+            record.remove_role(role.id)
+            await utils.saveGuild(ctx.bot, record)
+            self.bot.dispatch('requestable_role_update', ctx.guild, role.id)
+            index.invalidate_order()
+            self._list_invalidate(ctx.guild.id)
             return await utils.cmdSuccess(ctx, f'"{role.name}" has been removed as a requestable role.')
 
         # Modify role type
@@ -159,7 +239,10 @@ class RoleRequest(commands.Cog):
             if role_request_type == resolved_option:
                 return await utils.cmdFail(ctx, f'"{role.name}" is already a {resolved_option} requestable role.') 
 
-            utils.guildKeySet(ctx.bot, ctx.guild, f'roles.{role.id}.type', resolved_option)
+            record.set_role(role.id, resolved_option)
+            await utils.saveGuild(ctx.bot, record)
+            self.bot.dispatch('requestable_role_update', ctx.guild, role.id)
+            self._list_invalidate(ctx.guild.id)
             return await utils.cmdSuccess(ctx, f'"{role.name}" is now a {resolved_option} requestable role.')
 
         # Add role
@@ -167,7 +250,11 @@ class RoleRequest(commands.Cog):
             if resolved_option == 'add':
                 resolved_option = 'open'
 
-            utils.guildKeySet(ctx.bot, ctx.guild, f'roles.{role.id}', { 'type': resolved_option })
+            record.set_role(role.id, resolved_option)
+            await utils.saveGuild(ctx.bot, record)
+            self.bot.dispatch('requestable_role_update', ctx.guild, role.id)
+            index.invalidate_order()
+            self._list_invalidate(ctx.guild.id)
             return await utils.cmdSuccess(ctx, f'"{role.name}" has been added as a requestable {resolved_option} role.')
 
     @commands.command(name='about')
@@ -189,6 +276,96 @@ class RoleRequest(commands.Cog):
 
         return await ctx.send(embed=embed)
 
+    @commands.command(name='stats', hidden=True)
+    @commands.is_owner()
+    async def _stats(self, ctx):
+        '''Shows hot path metrics for this bot instance'''
+        if not self.bot.metrics.enabled:
+            return await utils.cmdFail(ctx, 'Metrics are disabled. (Set `metrics = True` in config.py to enable them.)')
+
+        m = self.bot.metrics
+        uptime = max(time.time() - m.start_time, 1)
+        embed = discord.Embed(title='Bot Statistics', timestamp=self.bot.start_time)
+        embed.set_footer(text='Up since')
+
+        def latency_lines(name, label):
+            histograms = sorted(m.histogram_group(name).items(), key=lambda i: -i[1].count)[:10]
+            return [f'`{dict(labels)[label]}` {h.count}x, p50 ≤{h.quantile(0.5) * 1000:g}ms, ' +
+                f'p99 ≤{h.quantile(0.99) * 1000:g}ms' for labels, h in histograms]
+
+        embed.add_field(name='Commands', value='\n'.join(latency_lines('command_latency', 'command')) or 'None',
+            inline=False)
+        embed.add_field(name='Storage Helpers', value='\n'.join(latency_lines('helper_latency', 'helper')) or 'None',
+            inline=False)
+
+        collected = m.collect()
+        cache = collected.get('guild_cache', {})
+        embed.add_field(name='Guild Cache', value=f'{cache.get("size", 0)} guilds, ' +
+            f'{cache.get("hit_rate", 0) * 100:.1f}% hit rate')
+
+        members = collected.get('member_cache', {})
+        embed.add_field(name='Member Cache', value=f'{members.get("size", 0)} members, ' +
+            f'{members.get("hit_rate", 0) * 100:.1f}% hit rate, {members.get("fetches", 0)} fetches')
+
+        routes = collected.get('outbound', {}).get('routes', {})
+        lag = m.histograms.get(('event_loop_lag', ()))
+        loop = collected.get('event_loop', {})
+        embed.add_field(name='Event Loop Lag', value=f'p99 ≤{lag.quantile(0.99) * 1000:g}ms, ' +
+            f'max {loop.get("lag_max_seconds", 0) * 1000:.1f}ms' if lag and lag.count else 'Not measured yet')
+
+        storage = collected.get('storage', {})
+        embed.add_field(name='Storage', value=f'{storage.get("reads", 0)} reads, {storage.get("writes", 0)} writes, ' +
+            f'{storage.get("queued", 0)} queued')
+
+        embed.add_field(name='REST Calls', value='\n'.join(f'`{r}` {n}' for r, n in sorted(routes.items())) or 'None')
+
+        limited = collected.get('limited')
+        if limited:
+            expiry = m.histograms.get(('expiry_check', ()))
+            embed.add_field(name='Reactions', value=f'{limited["reactions"]["received"] / uptime:.2f}/s, ' +
+                f'{limited["reactions"]["dropped"]} dropped on the fast path')
+            embed.add_field(name='Request Updates', value=f'{limited["updates"]["updates"]} updates, ' +
+                f'{limited["updates"]["stale"]} stale rejected, {limited["request_locks"]["contended"]} waited for a lock')
+            embed.add_field(name='Expiry Check', value=f'{expiry.count}x, avg {expiry.sum / expiry.count * 1000:.1f}ms'
+                if expiry and expiry.count else 'Not run yet')
+
+        return await self.bot.outbound.call(outbound.INTERACTIVE, 'send', lambda: ctx.send(embed=embed))
+
+    @commands.command(name='export', hidden=True)
+    @commands.is_owner()
+    async def _export(self, ctx, guild_ids: commands.Greedy[int]):
+        '''Exports the database, or only the given guilds, as gzipped NDJSON'''
+        counts = collections.Counter()
+
+        # Streamed into a temporary file a record at a time, the database is never held in memory as a whole. Records
+        # are read, encoded and compressed on a storage worker thread, EXPORT_CHUNK at a time so writes can go in
+        # between chunks.
+        with tempfile.TemporaryFile() as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                records = transfer.exportRecords(self.db.storage, guild_ids or None)
+
+                def write_chunk():
+                    written = 0
+                    for record in itertools.islice(records, EXPORT_CHUNK):
+                        gz.write((json.dumps(record) + '\n').encode('utf-8'))
+                        counts[record['type']] += 1
+                        written += 1
+                    return written
+
+                while await self.db.read(write_chunk): pass
+
+            size = f.tell()
+            f.seek(0)
+
+            limit = ctx.guild.filesize_limit if ctx.guild else 8 * 1024 * 1024
+            if size > limit:
+                return await utils.cmdFail(ctx, f'The export is too large to upload ({size / 1024 / 1024:.1f}MB). ' +
+                    'Use `python transfer.py export` on the host instead.')
+
+            file = discord.File(f, filename='rolerequest-export.ndjson.gz')
+            return await self.bot.outbound.call(outbound.INTERACTIVE, 'send', lambda: ctx.send(
+                f'Exported {counts["guild"]} guilds and {counts["request"]} requests.', file=file))
+
 def setup(bot):
     bot.add_cog(RoleRequest(bot))
     logging.info('[Extension] Core module loaded')
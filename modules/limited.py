@@ -1,78 +1,306 @@
+import asyncio
+import collections
+import contextlib
 import datetime
 import logging
+import time
 import typing
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
+from archive import RequestArchive
+import components
 import config
 from consts import *
+from expiry import ExpiryHeap
+from locks import KeyedLock
+from models import Request, Status
+import outbound
+from ratelimit import Ratelimiter
 import utils
 
 class LimitedRequests(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.db = bot.db
-        self.expiry_check.start()
-        self.expiry_check.clear_exception_types()
+        self.expiry = ExpiryHeap()
+        self.expiry_wakeup = asyncio.Event()
+        self.expiry_task = bot.loop.create_task(self.expiry_loop())
+
+        # Pending request message ids, and the number of pending requests per channel, used to drop unrelated
+        # reactions without touching storage. Until they have been loaded, every reaction takes the slow path.
+        self.pending_messages = set()
+        self.pending_channels = collections.Counter()
+        self.pending_loaded = False
+        self.reaction_stats = { 'received': 0, 'dropped': 0 }
+        self.interaction_stats = { 'received': 0, 'dropped': 0, 'rejected': 0 }
+        self.update_stats = { 'updates': 0, 'stale': 0, 'rest_calls': 0, 'rest_calls_saved': 0 }
+        self.request_locks = KeyedLock() # Message id -> lock serializing the request's transitions
+
+        # New requests carry approve/deny buttons; requests posted with reactions keep working either way
+        self.buttons = getattr(config, 'request_buttons', True)
+
+        self.ratelimiter = Ratelimiter()
+        self.ratelimiter_pruned = 0
+
+        self.archive = RequestArchive(getattr(config, 'archive_path', 'archive'))
+        self.retention_task = bot.loop.create_task(self.retention_loop())
+
+        bot.metrics.register('limited', self.stats)
 
     def cog_unload(self):
-        self.expiry_check.stop()
+        self.expiry_task.cancel()
+        self.retention_task.cancel()
+        self.bot.metrics.collectors.pop('limited', None)
 
-    @tasks.loop(minutes=10, reconnect=False)
-    async def expiry_check(self):
-        logging.info('[Limited] Checking for expired requests...')
+        # Commit any request changes still queued in the write-behind journal
+        self.bot.loop.create_task(self.db.flush())
+
+    # Sleeps until the earliest request deadline, or until a new request is scheduled
+    async def expiry_loop(self):
+        await self.bot.wait_until_ready()
+        await self.bot.reconciled.wait()
+        await self.rebuild_state()
+
+        while True:
+            self.expiry_wakeup.clear()
+            deadline = self.expiry.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - datetime.datetime.utcnow().timestamp())
+
+            try:
+                await asyncio.wait_for(self.expiry_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-        expire_before = (datetime.datetime.utcnow() - datetime.timedelta(hours=24)).timestamp() # 24 hours ago
+            start = time.perf_counter()
+            await self.expiry_check()
+            self.bot.metrics.observe('expiry_check', time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            'reactions': self.reaction_stats,
+            'interactions': self.interaction_stats,
+            'updates': self.update_stats,
+            'pending': len(self.pending_messages),
+            'scheduled_expiries': len(self.expiry),
+            'ratelimit_buckets': len(self.ratelimiter),
+            'request_locks': self.request_locks.stats()
+        }
+
+    # Rebuilds the in-memory request state (expiry heap, pending sets, ratelimits) in a single pass over storage, read
+    # a chunk of guilds at a time off the event loop
+    async def rebuild_state(self):
+        start = time.perf_counter()
+        self.expiry.clear()
+        self.pending_messages.clear()
+        self.pending_channels.clear()
+        self.ratelimiter.clear()
 
-        for server in self.db:
+        async for server in self.db.docs(lambda guild_id: utils.ownsGuild(self.bot, guild_id)):
             for message_id, request in server['requests'].items():
-                if request['created'] > expire_before: continue
-                
+                self.ratelimiter.record(server['id'], request['user'], message_id, request['created'], request['status'])
+
+                if request['status'] == Status.PENDING:
+                    self.expiry.push(server['id'], message_id, request['created'] + LIMITED_REQUEST_LIFETIME)
+                    self.pending_add(message_id, request['channel'])
+
+        self.pending_loaded = True
+        logging.info(f'[Limited] Rebuilt request state in {time.perf_counter() - start:.3f}s: ' +
+            f'{len(self.pending_messages)} pending requests scheduled for expiry')
+
+    def pending_add(self, message_id, channel_id):
+        self.pending_messages.add(int(message_id))
+        self.pending_channels[channel_id] += 1
+
+    def pending_discard(self, message_id, channel_id):
+        if int(message_id) not in self.pending_messages: return
+
+        self.pending_messages.discard(int(message_id))
+        self.pending_channels[channel_id] -= 1
+        if self.pending_channels[channel_id] <= 0: del self.pending_channels[channel_id]
+
+    def expiry_schedule(self, guild_id, request):
+        self.expiry.push(guild_id, request.message_id, request.created + LIMITED_REQUEST_LIFETIME)
+        self.expiry_wakeup.set()
+
+    async def expiry_check(self):
+        now = datetime.datetime.utcnow().timestamp()
+        due = self.expiry.pop_due(now)
+
+        # Drop ratelimit scores that are outside of every guild's window, at most once an hour
+        if now - self.ratelimiter_pruned > 60 * 60:
+            self.ratelimiter.prune(now - LIMITED_RATELIMIT_WINDOW_MAX * 60 * 60)
+            self.ratelimiter_pruned = now
+
+        # One guild lookup is shared between all of the guild's requests that are due. due is a snapshot taken off
+        # the expiry heap; the loop yields every LIMITED_EXPIRY_CHUNK requests, even if expiring them didn't. Requests
+        # that were resolved in the meantime are skipped by request_update.
+        processed = 0
+
+        for guild_id, message_ids in due.items():
+            guild = self.bot.get_guild(guild_id)
+
+            if not guild:
                 try:
-                    guild = await self.bot.fetch_guild(server['id'])
+                    guild = await self.bot.fetch_guild(guild_id)
                 except:
-                    logging.info(f'[Limited] Unable to fetch guild for request {message_id}')
+                    logging.info(f'[Limited] Unable to fetch guild {guild_id} for {len(message_ids)} expiring requests')
                     continue
 
-                await self.request_update(guild, message_id, request, 'expired')
-                logging.info(f'[Limited] Expired request {message_id}')
+            for message_id in message_ids:
+                try:
+                    if await self.request_update(guild, message_id, Status.EXPIRED) is not None:
+                        logging.info(f'[Limited] Expired request {message_id}')
+                except:
+                    logging.exception(f'[Limited] Unable to expire request {message_id}')
 
+                processed += 1
+                if processed % LIMITED_EXPIRY_CHUNK == 0: await asyncio.sleep(0)
 
-    @expiry_check.before_loop
-    async def before_expiry_check(self):
+    # Moves resolved requests older than the guild's retention period from its document into the archive. Runs over
+    # the guilds the bot is in a chunk at a time, so a pass never holds up the event loop for long.
+    async def retention_loop(self):
         await self.bot.wait_until_ready()
+        await self.bot.reconciled.wait()
+
+        while True:
+            guilds = list(self.bot.guilds)
+            archived = 0
+
+            for i, guild in enumerate(guilds):
+                try:
+                    archived += await self.retention_apply(guild)
+                except:
+                    logging.exception(f'[Limited] Unable to archive requests for guild {guild.id}')
+
+                if i % LIMITED_RETENTION_CHUNK == LIMITED_RETENTION_CHUNK - 1: await asyncio.sleep(0)
+
+            if archived: logging.info(f'[Limited] Archived {archived} resolved requests')
+            await asyncio.sleep(LIMITED_RETENTION_INTERVAL)
+
+    async def retention_apply(self, guild):
+        record = await utils.getGuildRecord(self.bot, guild)
+        if not record: return 0
+
+        archive_before = datetime.datetime.utcnow().timestamp() - record.options.retention * 60 * 60
+
+        resolved = [request for _, request in record.requests()
+            if request.status != Status.PENDING and request.created < archive_before]
+        if not resolved: return 0
+
+        # Appended on the storage writer thread, so the archive is written before the requests are removed below
+        await self.bot.db.write(self.archive.append, guild.id,
+            [(request.message_id, request.to_dict()) for request in resolved])
+
+        index = await utils.getRequestIndex(self.bot, guild)
+        for request in resolved:
+            record.remove_request(request.message_id)
+            index.remove(request.message_id)
+        await utils.saveGuild(self.bot, record)
+
+        return len(resolved)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
+        self.reaction_stats['received'] += 1
+
+        # Fast path: drop reactions that aren't on a pending request before touching storage
+        if self.pending_loaded and (payload.channel_id not in self.pending_channels or
+            payload.message_id not in self.pending_messages):
+            self.reaction_stats['dropped'] += 1
+            return
+
         if not payload.member: return
         if payload.member.bot: return
+        self.bot.member_cache.put(payload.member.guild.id, payload.member.id, payload.member)
 
-        doc = utils.getGuildDoc(self.bot, payload.member.guild)
-        if not doc: return
+        record = await utils.getGuildRecord(self.bot, payload.member.guild)
+        if not record: return
 
-        request = doc['requests'][str(payload.message_id)]
-        if not request: return
+        # Requests posted with buttons are only resolved through them, which checks the moderator's permissions
+        request = record.request(payload.message_id)
+        if not request or request.buttons: return
 
         if str(payload.emoji) == config.greenTick:
-            await self.request_update(payload.member.guild, payload.message_id, request, 'approved', payload.member)
+            await self.request_update(payload.member.guild, payload.message_id, Status.APPROVED, payload.member)
         elif str(payload.emoji) == config.redTick:
-            await self.request_update(payload.member.guild, payload.message_id, request, 'denied', payload.member)
+            await self.request_update(payload.member.guild, payload.message_id, Status.DENIED, payload.member)
         
         return
 
+    # Button clicks arrive as raw INTERACTION_CREATE events, which discord.py 1.x doesn't parse
+    @commands.Cog.listener()
+    async def on_socket_response(self, msg):
+        if msg.get('t') != 'INTERACTION_CREATE': return
+
+        interaction = msg['d']
+        if interaction.get('type') != components.MESSAGE_COMPONENT or 'guild_id' not in interaction: return
+
+        custom_id = interaction['data'].get('custom_id', '').split(':')
+        if len(custom_id) != 4 or custom_id[0] != 'limited': return
+
+        self.interaction_stats['received'] += 1
+        action, user_id, role_id = custom_id[1], int(custom_id[2]), int(custom_id[3])
+        message_id = int(interaction['message']['id'])
+
+        guild = self.bot.get_guild(int(interaction['guild_id']))
+        record = await utils.getGuildRecord(self.bot, guild) if guild else None
+        request = record.request(message_id) if record else None
+
+        # The custom id names the request's user and role, which have to match the request stored for the message
+        if not (request and request.status == Status.PENDING and request.user == user_id and
+            request.role == role_id and action in ('approve', 'deny')):
+            self.interaction_stats['dropped'] += 1
+            return await self.bot.outbound.call(outbound.INTERACTIVE, 'interaction',
+                lambda: components.replyEphemeral(self.bot.http, interaction, 'This request is no longer pending.'))
+
+        # Anyone who can see the requests channel can click a button, so moderators are told apart by permission
+        permissions = discord.Permissions(int(interaction['member'].get('permissions', 0)))
+        if not permissions.manage_roles:
+            self.interaction_stats['rejected'] += 1
+            return await self.bot.outbound.call(outbound.INTERACTIVE, 'interaction',
+                lambda: components.replyEphemeral(self.bot.http, interaction,
+                    'You need the Manage Roles permission to approve or deny requests.'))
+
+        user = interaction['member']['user']
+        mod = guild.get_member(int(user['id'])) or f'{user["username"]}#{user["discriminator"]}'
+        status = Status.APPROVED if action == 'approve' else Status.DENIED
+
+        # Acknowledged right away, as resolving the request can take longer than Discord waits for a response; the
+        # message is edited once it's resolved. A failed acknowledgement doesn't stop the request from being resolved.
+        try:
+            await self.bot.outbound.call(outbound.INTERACTIVE, 'interaction',
+                lambda: components.deferUpdate(self.bot.http, interaction))
+            deferred = True
+        except discord.HTTPException as e:
+            logging.info(f'[Limited] Unable to acknowledge the click on request {message_id}: {e}')
+            deferred = False
+
+        # Another moderator may have resolved the request while this click waited for it
+        if await self.request_update(guild, message_id, status, mod) is None:
+            self.interaction_stats['dropped'] += 1
+            if not deferred: return
+
+            await self.bot.outbound.call(outbound.INTERACTIVE, 'interaction',
+                lambda: components.followupEphemeral(self.bot.http, interaction, 'This request is no longer pending.'))
+
+    def request_buttons(self, user_id, role_id):
+        return [components.actionRow(
+            components.button(f'limited:approve:{user_id}:{role_id}', 'Approve', components.SUCCESS, config.greenTick),
+            components.button(f'limited:deny:{user_id}:{role_id}', 'Deny', components.DANGER, config.redTick))]
+
     # Called from join command in core.py
     async def request_create(self, ctx, role):
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
 
-        channel = doc['requests_opts']['channel']
-        users_requests = list(filter(lambda e: e['user'] == ctx.author.id, doc['requests'].values()))
+        index = await utils.getRequestIndex(ctx.bot, ctx.guild)
+        opts = record.options
 
-        if doc['requests_opts']['hidejoins']:
-            try:
-                await ctx.message.delete(delay=5)
-            except:
-                pass
+        channel = opts.channel
+
+        if opts.hidejoins:
+            ctx.bot.deletions.schedule(ctx.message.channel, ctx.message.id, 5)
             delete = 15
         else: 
             delete = None
@@ -81,60 +309,68 @@ class LimitedRequests(commands.Cog):
             return await utils.cmdFail(ctx, f'Limited role requests are currently disabled for this guild.', 
                 delete_after = delete)
 
-        existing_request = list(filter(lambda e: e['role'] == role.id, users_requests))
-        if existing_request and existing_request[-1]['status'] == 'pending':
+        _, existing_request = index.latest_request(ctx.author.id, role.id)
+        if existing_request and existing_request.status == Status.PENDING:
             return await utils.cmdFail(ctx, f'You already have a request pending for the role "{role.name}".', 
                 delete_after = delete)
 
-        # Ratelimit if enabled & ratelimit score above maximum; score calculated from status of requests in last 24h
-        if doc['requests_opts']['ratelimit']:
-            rl_score = 0
-            for r in users_requests:
-                 rl_score += 0 if not r["status"] in LIMITED_RATELIMIT_SCORES else LIMITED_RATELIMIT_SCORES[r["status"]]
+        # Ratelimit if enabled & ratelimit score above maximum; score calculated from status of requests in the window
+        if opts.ratelimit:
+            window = opts.ratelimit_window * 60 * 60
+            rl_score = self.ratelimiter.score(ctx.guild.id, ctx.author.id, datetime.datetime.utcnow().timestamp() - window)
 
-            if rl_score > LIMITED_RATELIMIT_SCORE_MAX:
+            if rl_score > opts.ratelimit_max:
                 return await utils.cmdFail(ctx, 'You have too many recent requests. Please try again later.', 
                 delete_after = delete)
 
-        embed = discord.Embed(
-            title='Limited Role Request',
-            description=f'<@{ctx.message.author.id}> requested the <@&{role.id}> role.',
-            color=discord.Colour.blurple(),
-            timestamp=datetime.datetime.utcnow() + datetime.timedelta(hours=24))
-        embed.set_author(name=f'{ctx.message.author} ({ctx.message.author.id})', icon_url=ctx.message.author.avatar_url)
-        embed.add_field(name='Status', value='Pending. React to approve or deny the request.')
-        embed.set_footer(text='Request expires')
-
-        embed_message = await ctx.guild.get_channel(channel).send(embed=embed)
-        await embed_message.add_reaction(config.greenTick)
-        await embed_message.add_reaction(config.redTick)
-
-        utils.guildKeySet(ctx.bot, ctx.guild, f'requests.{embed_message.id}', { 
-            'channel': embed_message.channel.id,
-            'created': datetime.datetime.utcnow().timestamp(),
-            'role': role.id, 
-            'status': 'pending',
-            'user': ctx.author.id, 
-        })
+        created = datetime.datetime.utcnow().timestamp()
+
+        embed = self.request_embed(ctx.author, ctx.author.id, role.id, discord.Colour.blurple(),
+            'Pending. Use the buttons to approve or deny the request.' if self.buttons else
+            'Pending. React to approve or deny the request.', 'Request expires',
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=LIMITED_REQUEST_LIFETIME))
+
+        # Buttons are part of the message, saving the two reaction calls
+        if self.buttons:
+            data = await self.bot.outbound.call(outbound.EMBED, 'send', lambda: components.sendMessage(self.bot.http,
+                channel, embed=embed, components=self.request_buttons(ctx.author.id, role.id)))
+            message_id = int(data['id'])
+            self.update_stats['rest_calls_saved'] += 2
+        else:
+            embed_message = await self.bot.outbound.call(outbound.EMBED, 'send',
+                lambda: ctx.guild.get_channel(channel).send(embed=embed))
+            for emoji in (config.greenTick, config.redTick):
+                await self.bot.outbound.submit(outbound.EMBED, 'reaction',
+                    lambda emoji=emoji: embed_message.add_reaction(emoji))
+            message_id = embed_message.id
+
+        request = Request(message_id, channel=channel, created=created, role=role.id, user=ctx.author.id,
+            buttons=self.buttons)
+        record.add_request(request)
+        await utils.saveGuild(ctx.bot, record)
+
+        index.add(message_id, request)
+        self.pending_add(message_id, channel)
+        self.ratelimiter.record(ctx.guild.id, ctx.author.id, message_id, created, Status.PENDING)
+        self.expiry_schedule(ctx.guild.id, request)
 
         return await utils.cmdSuccess(ctx, f'Your request for "{role.name}" has been submitted.', delete_after = delete)
 
     # Called from leave command in core.py
     async def request_cancel(self, ctx, role):
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
-
-        requests = list(filter(
-            lambda e: e[1]['user'] == ctx.author.id and e[1]['role'] == role.id, doc['requests'].items()
-        ))
-        request = requests[-1] if requests else (None, None)
+        index = await utils.getRequestIndex(ctx.bot, ctx.guild)
+        message_id, request = index.latest_request(ctx.author.id, role.id) if index else (None, None)
 
-        if not request[1] or request[1]['status'] != 'pending':
+        if not request or request.status != Status.PENDING:
             return await utils.cmdFail(ctx, f'You do not have a request pending for the role "{role.name}".')
 
-        await self.request_update(ctx.guild, request[0], request[1], 'cancelled')
+        if await self.request_update(ctx.guild, message_id, Status.CANCELLED) is None:
+            return await utils.cmdFail(ctx, f'Your request for "{role.name}" was resolved before it could be cancelled.')
+
         return await utils.cmdSuccess(ctx, f'Your request for "{role.name}" has been cancelled.')
 
-    async def request_update(self, guild, message_id, request, status, mod = None):
+    # Embed colour, footer and status text of a request resolved as status, and the end of the DM sent for it
+    def request_layout(self, status, mod = None):
         statuses = {
             'cancelled': {
                 'colour': discord.Colour.darker_grey(),
@@ -161,43 +397,125 @@ class LimitedRequests(commands.Cog):
             }
         }
 
-        member = await guild.fetch_member(request['user'])
-        role = guild.get_role(request['role'])
-        layout = statuses[status]
-
-        if status == 'approved':
-            await member.add_roles(role, reason='User role request approved')
-
-        if status == 'expired':
-            utils.guildKeyDel(self.bot, guild, f'requests.{message_id}') 
+        return statuses[status]
+
+    # Moves the request to status and updates its message; returns the number of REST calls made, or None if the
+    # request was no longer pending
+    async def request_update(self, guild, message_id, status, mod = None):
+        message_id = int(message_id)
+
+        # Transitions of a request run one at a time, and the request is read again once it's this one's turn: two
+        # moderators reacting at once, or a reaction racing the expiry, must not resolve it twice. Transitions of
+        # different requests don't wait on each other.
+        async with self.request_locks.hold(message_id):
+            record = await utils.getGuildRecord(self.bot, guild)
+            request = record.request(message_id) if record else None
+
+            # Rejected before any REST call is made
+            if not (request and request.status.can_become(status)):
+                self.update_stats['stale'] += 1
+                logging.debug(f'[Limited] Rejected stale transition of request {message_id} to {status}')
+                return None
+
+            return await self.request_transition(guild, record, request, status, self.request_layout(status, mod))
+
+    # Resolves a pending request; only called by request_update, with the request's lock held
+    async def request_transition(self, guild, record, request, status, layout):
+        rest_calls = 0
+        role = guild.get_role(request.role)
+
+        # Resolve everything from the gateway and member caches, only falling back to REST on a miss
+        member, fetched = await utils.getMember(self.bot, guild, request.user)
+        if fetched: rest_calls += 1
+
+        if status == Status.APPROVED and member:
+            rest_calls += 1
+            await self.bot.outbound.call(outbound.ROLE, 'roles',
+                lambda: member.add_roles(role, reason='User role request approved'))
+
+        await self.request_resolve(guild, record, request, status)
+        await utils.saveGuild(self.bot, record)
+
+        # DMs are delivered in the background
+        if status != Status.CANCELLED and member:
+            rest_calls += 1
+            await self.bot.outbound.submit(outbound.DM, 'dm',
+                lambda: member.send(f'Your request for "{role}" in "{guild}" has {layout["dm"]}'))
+
+        rest_calls += await self.request_message_update(guild, request, member, layout)
+
+        self.update_stats['updates'] += 1
+        self.update_stats['rest_calls'] += rest_calls
+        logging.debug(f'[Limited] Request {request.message_id} {status} using {rest_calls} REST calls')
+        return rest_calls
+
+    # Applies a transition to the in-memory state and the record, without saving it. Expired requests are archived
+    # on the storage writer thread and removed, others keep their new status until retention archives them.
+    async def request_resolve(self, guild, record, request, status):
+        message_id = request.message_id
+
+        self.pending_discard(message_id, request.channel)
+        self.expiry.discard(message_id)
+        self.ratelimiter.update(guild.id, request.user, message_id, status)
+
+        if status == Status.EXPIRED:
+            await self.bot.db.write(self.archive.append, guild.id,
+                [(message_id, dict(request.to_dict(), status=status.value))])
+            record.remove_request(message_id)
+            index = self.bot.guild_cache.peek_derived(guild.id, 'requests') # Not built yet, it won't include it
+            if index: index.remove(message_id)
         else:
-            utils.guildKeySet(self.bot, guild, f'requests.{message_id}.status', status) 
+            request.status = status
 
-        if request['status'] == 'pending':
-            channel = await self.bot.fetch_channel(request['channel'])
+    # Rebuilds the embed of a resolved request and replaces its buttons or reactions; returns the REST calls made
+    async def request_message_update(self, guild, request, member, layout):
+        message_id = request.message_id
 
+        # The embed is rebuilt from the request, so the message never has to be fetched
+        embed = self.request_embed(member or self.bot.get_user(request.user), request.user, request.role,
+            layout['colour'], layout['status'], layout['footer'], datetime.datetime.utcnow())
+
+        # Editing the embed also removes the buttons
+        if request.buttons:
+            self.update_stats['rest_calls_saved'] += 1
             try:
-                embed_message = await channel.fetch_message(message_id)
-
-                embed = embed_message.embeds[0]
-                embed.colour = layout['colour']
-                embed.timestamp = datetime.datetime.utcnow()
-                embed.set_footer(text=layout['footer'])
-                embed.remove_field(0)
-                embed.add_field(name='Status', value=layout['status'])
-                
-                await embed_message.edit(embed=embed)
-                await embed_message.clear_reactions()
-            except:
-                pass
+                await self.bot.outbound.call(outbound.EMBED, 'edit', lambda: components.editMessage(self.bot.http,
+                    request.channel, message_id, embed=embed))
+            except discord.HTTPException as e:
+                logging.info(f'[Limited] Unable to update the message of request {message_id}: {e}')
+            return 1
+
+        rest_calls = 2
+        channel = guild.get_channel(request.channel)
+        if not channel:
+            rest_calls += 1
+            channel = await self.bot.fetch_channel(request.channel)
+
+        # The embed edit and reaction clear run concurrently
+        embed_message = channel.get_partial_message(message_id)
+        await asyncio.gather(
+            self.bot.outbound.call(outbound.EMBED, 'edit', lambda: embed_message.edit(embed=embed)),
+            self.bot.outbound.call(outbound.EMBED, 'reaction', lambda: embed_message.clear_reactions()),
+            return_exceptions=True)
+        return rest_calls
+
+    # user may be None if the requester is no longer cached or in the guild
+    def request_embed(self, user, user_id, role_id, colour, status, footer, timestamp):
+        embed = discord.Embed(
+            title='Limited Role Request',
+            description=f'<@{user_id}> requested the <@&{role_id}> role.',
+            color=colour,
+            timestamp=timestamp)
+        embed.add_field(name='Status', value=status)
+        embed.set_footer(text=footer)
+
+        if user:
+            embed.set_author(name=f'{user} ({user.id})', icon_url=user.avatar_url)
+        else:
+            embed.set_author(name=f'{user_id}')
+
+        return embed
 
-            if status != 'cancelled':
-                try:
-                    await member.send(f'Your request for "{role}" in "{guild}" has {layout["dm"]}')
-                except:
-                    pass
-        return
-            
     @commands.group(name='limited', invoke_without_command=True, case_insensitive=True)
     @commands.has_guild_permissions(manage_guild=True)
     @commands.guild_only()
@@ -206,47 +524,54 @@ class LimitedRequests(commands.Cog):
         '''
         Manages settings for limited role requests
         '''
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
+        opts = (await utils.getGuildRecord(ctx.bot, ctx.guild)).options
 
-        channel = doc['requests_opts']['channel']
-        hidejoins = doc['requests_opts']['hidejoins']
-        ratelimit = doc['requests_opts']['ratelimit']
+        channel = opts.channel
+        hidejoins = opts.hidejoins
+        ratelimit = opts.ratelimit
+        rl_max = opts.ratelimit_max
+        rl_window = opts.ratelimit_window
+        retention = opts.retention
 
         embed = discord.Embed(title=f'Limited Role Request Options for: {ctx.guild}')
         embed.set_footer(text=f'Use the "{ctx.prefix}help limited" command for help on changing these settings.') 
 
         if channel == None:
             embed.description = 'Requests are currently disabled for this guild.'
-            return await ctx.send(embed=embed)
+            return await self.bot.outbound.call(outbound.INTERACTIVE, 'send', lambda: ctx.send(embed=embed))
 
         embed.add_field(name='Posting Channel', value=f'<#{channel}>')
         embed.add_field(name='Join Command Hiding', value='Enabled' if hidejoins else 'Disabled')
-        embed.add_field(name='Join Command Ratelimiting', value='Enabled' if ratelimit else 'Disabled')
+        embed.add_field(name='Join Command Ratelimiting',
+            value=f'Enabled (score {rl_max} per {rl_window}h)' if ratelimit else 'Disabled')
+        embed.add_field(name='Request Retention', value=f'{retention}h')
         
-        return await ctx.send(embed=embed)
+        return await self.bot.outbound.call(outbound.INTERACTIVE, 'send', lambda: ctx.send(embed=embed))
 
     @_limited.command(name='disable')
     @utils.guild_in_db()
     async def _limited_disable(self, ctx):
         '''Disables limited role requests for the guild'''
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
 
-        if doc['requests_opts']['channel'] == None:
+        if record.options.channel == None:
             return await utils.cmdFail(ctx, f'Requests are already disabled for this guild.')
 
-        utils.guildKeySet(ctx.bot, ctx.guild, 'requests_opts.channel', None)
+        record.options.channel = None
+        await utils.saveGuild(ctx.bot, record)
         return await utils.cmdSuccess(ctx, f'Requests are now disabled for this guild.')
 
     @_limited.command(name='channel')
     @utils.guild_in_db()
     async def _limited_channel(self, ctx, channel: discord.TextChannel):
         '''Sets the channel that limited role requests will be posted in'''
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
         
-        if doc['requests_opts']['channel'] == channel.id:
+        if record.options.channel == channel.id:
             return await utils.cmdFail(ctx, f'The requests channel is already {channel}.')
             
-        utils.guildKeySet(ctx.bot, ctx.guild, 'requests_opts.channel', channel.id)
+        record.options.channel = channel.id
+        await utils.saveGuild(ctx.bot, record)
         return await utils.cmdSuccess(ctx, f'The requests channel is now {channel}.')
 
     @_limited.command(name='hidejoins', aliases=['hidejoin'])
@@ -255,16 +580,257 @@ class LimitedRequests(commands.Cog):
         '''Sets automatic deletion of join commands for limited roles'''
         return await self._limited_option_toggle(ctx, setting, 'hidejoins', 'hiding')
 
-    @_limited.command(name='ratelimit', aliases=['ratelimiting', 'ratelimited'])
+    @_limited.group(name='ratelimit', aliases=['ratelimiting', 'ratelimited'], invoke_without_command=True,
+        case_insensitive=True)
+    @commands.has_guild_permissions(manage_guild=True)
     @utils.guild_in_db()
     async def _limited_ratelimited(self, ctx, setting: typing.Optional[bool]):
         '''Sets ratelimiting of join commands for limited roles'''
         return await self._limited_option_toggle(ctx, setting, 'ratelimit', 'ratelimiting')
 
+    @_limited_ratelimited.command(name='max', aliases=['score'])
+    @commands.has_guild_permissions(manage_guild=True)
+    @utils.guild_in_db()
+    async def _limited_ratelimited_max(self, ctx, score: int):
+        '''
+        Sets the maximum ratelimit score a user can have
+
+        Pending requests score 3, cancelled requests 5 and denied requests 7. Users with a score above the maximum
+        within the ratelimit window can't make new requests.
+        '''
+        if score < 0:
+            return await utils.cmdFail(ctx, f'The maximum ratelimit score can not be negative.')
+
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+        record.options.ratelimit_max = score
+        await utils.saveGuild(ctx.bot, record)
+        return await utils.cmdSuccess(ctx, f'The maximum ratelimit score is now **{score}**.')
+
+    @_limited_ratelimited.command(name='window')
+    @commands.has_guild_permissions(manage_guild=True)
+    @utils.guild_in_db()
+    async def _limited_ratelimited_window(self, ctx, hours: int):
+        '''Sets how many hours requests count towards a user's ratelimit score'''
+        if not 1 <= hours <= LIMITED_RATELIMIT_WINDOW_MAX:
+            return await utils.cmdFail(ctx, f'The ratelimit window must be between 1 and {LIMITED_RATELIMIT_WINDOW_MAX} hours.')
+
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+        record.options.ratelimit_window = hours
+        await utils.saveGuild(ctx.bot, record)
+        return await utils.cmdSuccess(ctx, f'The ratelimit window is now **{hours}** hours.')
+
+    @_limited.command(name='retention')
+    @commands.has_guild_permissions(manage_guild=True)
+    @utils.guild_in_db()
+    async def _limited_retention(self, ctx, hours: int):
+        '''
+        Sets how many hours resolved requests are kept before being archived
+
+        Archived requests can still be viewed with the history command, but no longer count towards ratelimit
+        scores after the bot restarts.
+        '''
+        if hours < 1:
+            return await utils.cmdFail(ctx, f'The retention period must be at least 1 hour.')
+
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+        record.options.retention = hours
+        await utils.saveGuild(ctx.bot, record)
+        return await utils.cmdSuccess(ctx, f'Resolved requests are now archived after **{hours}** hours.')
+
+    @_limited.command(name='history')
+    @commands.has_guild_permissions(manage_guild=True)
+    @utils.guild_in_db()
+    async def _limited_history(self, ctx, member: typing.Optional[discord.Member]):
+        '''Lists the most recent archived requests, optionally only those of a member'''
+        user_id = member.id if member else None
+
+        # Streamed from the archive on a worker thread, only the most recent matches are kept in memory
+        def scan():
+            history = collections.deque(maxlen=LIMITED_HISTORY_LIMIT)
+            for request in self.archive.iter(ctx.guild.id):
+                if user_id and request['user'] != user_id: continue
+                history.append(request)
+            return history
+
+        history = await asyncio.get_event_loop().run_in_executor(None, scan)
+
+        if not history:
+            return await utils.cmdFail(ctx, f'There are no archived requests' + (f' for {member}.' if member else '.'))
+
+        lines = []
+        for request in reversed(history):
+            created = datetime.datetime.utcfromtimestamp(request['created']).strftime('%Y-%m-%d %H:%M')
+            lines.append(f'`{created}` <@{request["user"]}> <@&{request["role"]}> **{request["status"].title()}**')
+
+        title = f'Archived Requests' + (f' for {member}' if member else '')
+        return await utils.sendListEmbed(ctx, title, lines, footer=f'Showing the {len(lines)} most recent requests.')
+
+    @_limited.command(name='approve', usage='<role|user|all>')
+    @commands.has_guild_permissions(manage_roles=True)
+    @commands.bot_has_guild_permissions(manage_roles=True)
+    @utils.guild_in_db()
+    async def _limited_approve(self, ctx, target: typing.Union[discord.Role, discord.Member, discord.User, str]):
+        '''Approves every pending request for a role, of a user, or all pending requests'''
+        return await self.request_bulk_update(ctx, target, Status.APPROVED)
+
+    @_limited.command(name='deny', usage='<role|user|all>')
+    @commands.has_guild_permissions(manage_roles=True)
+    @utils.guild_in_db()
+    async def _limited_deny(self, ctx, target: typing.Union[discord.Role, discord.Member, discord.User, str]):
+        '''Denies every pending request for a role, of a user, or all pending requests'''
+        return await self.request_bulk_update(ctx, target, Status.DENIED)
+
+    # Resolves every pending request matching target: grants the roles, saves the granted requests as resolved with a
+    # single write, then sends the DMs and updates the request messages, LIMITED_BULK_CONCURRENCY requesters at a time.
+    # Each requester gets one DM for all of their requests, and one role grant if the bot has the members intent (see
+    # grant_user).
+    async def request_bulk_update(self, ctx, target, status):
+        if isinstance(target, str) and target.lower() != 'all':
+            return await utils.cmdFail(ctx, f'"{target}" is not a role, a user or "all".')
+
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+
+        if isinstance(target, discord.Role):
+            candidates = [request for _, request in record.requests() if request.role == target.id]
+            described = f' for the role "{target.name}"'
+        elif isinstance(target, str):
+            candidates = [request for _, request in record.requests()]
+            described = ''
+        else:
+            index = await utils.getRequestIndex(ctx.bot, ctx.guild)
+            candidates = [index.get(message_id) for message_id in index.by_user.get(target.id, ())]
+            described = f' of {target}'
+
+        # Requests with a transition already in progress are left to it
+        requests = [request for request in candidates if request.status.can_become(status) and
+            not self.request_locks.locked(request.message_id)]
+
+        if not requests:
+            return await utils.cmdFail(ctx, f'There are no pending requests{described}.')
+
+        by_user = {}
+        for request in requests:
+            by_user.setdefault(request.user, []).append(request)
+
+        layout = self.request_layout(status, ctx.author)
+        verbs = ('Approving', 'Approved') if status == Status.APPROVED else ('Denying', 'Denied')
+        progress = { 'done': 0, 'resolved': 0, 'ungranted': 0, 'failed': 0, 'rest_calls': 0 }
+
+        def progress_text(final=False):
+            text = f'{verbs[final]} {progress["resolved"] if final else len(requests)} requests{described} from ' + \
+                f'{len(by_user)} users'
+            if not final: text += f'... ({progress["done"]}/{len(requests)})'
+            if final and progress['ungranted']:
+                text += f' ({progress["ungranted"]} left pending, their roles could not be granted)'
+            if final and progress['failed']: text += f' ({progress["failed"]} messages could not be updated)'
+            return text + '.'
+
+        message = await utils.cmdSuccess(ctx, progress_text())
+
+        # Grants the user's requested roles; returns the member, who may be None if they left, and the roles
+        async def grant_user(user_id, user_requests):
+            async with semaphore:
+                member, fetched = await utils.getMember(self.bot, ctx.guild, user_id)
+                if fetched: progress['rest_calls'] += 1
+
+                roles = [role for role in (ctx.guild.get_role(r.role) for r in user_requests) if role]
+
+                # One member edit sets the member's whole role list, so it's only used when the members intent keeps
+                # their roles current; otherwise each role gets a call
+                atomic = len(roles) == 1 or not ctx.bot.intents.members
+
+                if status == Status.APPROVED and member and roles:
+                    calls = len(roles) if atomic else 1
+                    progress['rest_calls'] += calls
+                    self.update_stats['rest_calls_saved'] += len(roles) - calls
+                    await self.bot.outbound.call(outbound.ROLE, 'roles',
+                        lambda: member.add_roles(*roles, reason='User role request approved', atomic=atomic))
+
+                return member, roles
+
+        async def notify_user(user_requests, member, roles):
+            async with semaphore:
+                if member and roles:
+                    names = ', '.join(f'"{role}"' for role in roles)
+                    progress['rest_calls'] += 1
+                    self.update_stats['rest_calls_saved'] += len(roles) - 1
+                    await self.bot.outbound.submit(outbound.DM, 'dm', lambda: member.send(
+                        f'Your request{"s" if len(roles) > 1 else ""} for {names} in "{ctx.guild}" ' +
+                        f'{"have" if len(roles) > 1 else "has"} {layout["dm"]}'))
+
+                for request in user_requests:
+                    # Awaited before adding, as other users' updates add to the count meanwhile
+                    try:
+                        rest_calls = await self.request_message_update(ctx.guild, request, member, layout)
+                        progress['rest_calls'] += rest_calls
+                    except:
+                        progress['failed'] += 1
+                        logging.exception(f'[Limited] Unable to update the message of request {request.message_id}')
+                    progress['done'] += 1
+
+        async def report():
+            while True:
+                await asyncio.sleep(LIMITED_BULK_PROGRESS_INTERVAL)
+                await self.bot.outbound.call(outbound.INTERACTIVE, 'edit',
+                    lambda: message.edit(content=f'{config.greenTick} {progress_text()}'))
+
+        semaphore = asyncio.Semaphore(LIMITED_BULK_CONCURRENCY)
+        reporter = asyncio.ensure_future(report())
+
+        try:
+            # The requests stay locked until they're saved, and are read again once locked; requests resolved
+            # meanwhile are left out
+            async with contextlib.AsyncExitStack() as locks:
+                for request in requests:
+                    await locks.enter_async_context(self.request_locks.hold(request.message_id))
+
+                record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+                resolvable = {}
+                for user_id, user_requests in by_user.items():
+                    current = [record.request(request.message_id) for request in user_requests] if record else []
+                    current = [request for request in current if request and request.status.can_become(status)]
+                    progress['done'] += len(user_requests) - len(current)
+                    if current: resolvable[user_id] = current
+
+                grants = await asyncio.gather(*(grant_user(user_id, user_requests)
+                    for user_id, user_requests in resolvable.items()), return_exceptions=True)
+
+                # A failed grant, e.g. for a role above the bot's, leaves the user's requests pending
+                granted = []
+                for (user_id, user_requests), grant in zip(resolvable.items(), grants):
+                    if isinstance(grant, Exception):
+                        progress['ungranted'] += len(user_requests)
+                        progress['done'] += len(user_requests)
+                        logging.info(f'[Limited] Unable to grant the requested roles of user {user_id}: {grant}')
+                        continue
+
+                    for request in user_requests:
+                        await self.request_resolve(ctx.guild, record, request, status)
+                    progress['resolved'] += len(user_requests)
+                    granted.append((user_requests, *grant))
+
+                if granted: await utils.saveGuild(ctx.bot, record)
+
+            results = await asyncio.gather(*(notify_user(*grant) for grant in granted), return_exceptions=True)
+        finally:
+            reporter.cancel()
+
+        for (user_requests, member, roles), result in zip(granted, results):
+            if isinstance(result, Exception):
+                logging.info(f'[Limited] Unable to notify user {user_requests[0].user} of their requests: {result}')
+
+        self.update_stats['updates'] += progress['resolved']
+        self.update_stats['rest_calls'] += progress['rest_calls']
+        logging.info(f'[Limited] {verbs[1]} {progress["resolved"]} requests in {ctx.guild.id} using ' +
+            f'{progress["rest_calls"]} REST calls')
+
+        return await self.bot.outbound.call(outbound.INTERACTIVE, 'edit',
+            lambda: message.edit(content=f'{config.greenTick} {progress_text(final=True)}'))
+
     # Generic togglable option prototype for hidejoins and ratelimit
     async def _limited_option_toggle(self, ctx, user_setting, setting_key, setting_string):
-        doc = utils.getGuildDoc(ctx.bot, ctx.guild)
-        current = doc['requests_opts'][setting_key]
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+        current = getattr(record.options, setting_key)
 
         if user_setting is None:
             user_setting = not current
@@ -274,7 +840,8 @@ class LimitedRequests(commands.Cog):
         if user_setting == current:
             return await utils.cmdFail(ctx, f'Limited role join command {setting_string} is already **{human}**.')
 
-        utils.guildKeySet(ctx.bot, ctx.guild, f'requests_opts.{setting_key}', user_setting)
+        setattr(record.options, setting_key, user_setting)
+        await utils.saveGuild(ctx.bot, record)
         return await utils.cmdSuccess(ctx, f'Limited role join command {setting_string} is now **{human}**.')
             
 def setup(bot):
@@ -0,0 +1,320 @@
+import logging
+import time
+
+import discord
+from discord.ext import commands
+
+from cache import MISSING
+import components
+import config
+from consts import *
+import outbound
+from roleupdates import RoleUpdateCoalescer
+import utils
+
+# The key an emoji is indexed under: the id of a custom emoji, which survives renames, or the unicode emoji itself.
+# Takes the emoji of a reaction event or one written in a command ('<:name:id>', 'name:id' or unicode).
+def emojiKey(emoji):
+    if isinstance(emoji, discord.PartialEmoji):
+        return str(emoji.id) if emoji.id else emoji.name
+
+    match = components.CUSTOM_EMOJI.fullmatch(str(emoji))
+    return match.group(3) if match else str(emoji)
+
+class RoleMenus(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.db = bot.db
+
+        # Menu entries of open roles, so reactions and clicks are dispatched without touching storage. Until every
+        # guild's menus have been loaded, events index the menus of their guild first.
+        self.entries = {} # (message id, emoji key) -> (guild id, role id)
+        self.menu_keys = {} # message id -> emoji keys of the menu's indexed entries
+        self.guild_menus = {} # guild id -> message ids of the guild's menus
+        self.loaded = False
+        self.event_stats = { 'received': 0, 'dropped': 0 }
+
+        self.updates = RoleUpdateCoalescer(bot.outbound, bot.http, reason='User joined or left role via role menu',
+            members_intent=bot.intents.members)
+        self.load_task = bot.loop.create_task(self.load_menus())
+
+        bot.metrics.register('rolemenu', self.stats)
+
+    def cog_unload(self):
+        self.load_task.cancel()
+        self.bot.metrics.collectors.pop('rolemenu', None)
+
+    def stats(self):
+        return {
+            'events': self.event_stats,
+            'menus': len(self.menu_keys),
+            'entries': len(self.entries),
+            'role_updates': self.updates.stats()
+        }
+
+    # Indexes the menus of every guild on this process' shards, read a chunk of guilds at a time off the event loop
+    async def load_menus(self):
+        await self.bot.wait_until_ready()
+        await self.bot.reconciled.wait()
+        start = time.perf_counter()
+
+        async for server in self.db.docs(lambda guild_id: utils.ownsGuild(self.bot, guild_id)):
+            # Records cached meanwhile may have menus added or removed since the document was read
+            record = self.bot.guild_cache.peek(server['id'])
+
+            if record is MISSING and server.get('rolemenus'):
+                self.index_guild(server['id'],
+                    { int(message_id): menu for message_id, menu in server['rolemenus'].items() },
+                    { int(role_id): role['type'] for role_id, role in server['roles'].items() })
+            elif record is not MISSING and record:
+                self.index_guild(record.id, record.menus, record.roles)
+
+        self.loaded = True
+        logging.info(f'[RoleMenu] Indexed {len(self.menu_keys)} role menus in {time.perf_counter() - start:.3f}s')
+
+    # roles are the guild's requestable roles as role id -> role type; only entries of open roles are indexed
+    def index_guild(self, guild_id, menus, roles):
+        for message_id, menu in menus.items():
+            self.index_menu(guild_id, message_id, menu, roles)
+
+    def index_menu(self, guild_id, message_id, menu, roles):
+        self.unindex_menu(guild_id, message_id)
+        keys = []
+
+        for entry in menu['entries']:
+            if roles.get(entry['role']) != 'open': continue
+
+            key = emojiKey(entry['emoji'])
+            self.entries[(message_id, key)] = (guild_id, entry['role'])
+            keys.append(key)
+
+        self.menu_keys[message_id] = keys
+        self.guild_menus.setdefault(guild_id, set()).add(message_id)
+
+    def unindex_menu(self, guild_id, message_id):
+        for key in self.menu_keys.pop(message_id, ()):
+            del self.entries[(message_id, key)]
+
+        menus = self.guild_menus.get(guild_id)
+        if menus is None: return
+
+        menus.discard(message_id)
+        if not menus: del self.guild_menus[guild_id]
+
+    # Returns (guild id, role id) of the menu entry, or None if it isn't one. Dispatch only reads storage while menus
+    # are still being loaded.
+    async def lookup(self, guild_id, message_id, key):
+        if not self.loaded and guild_id and guild_id not in self.guild_menus:
+            guild = self.bot.get_guild(guild_id)
+            record = await utils.getGuildRecord(self.bot, guild) if guild else None
+            if record: self.index_guild(record.id, record.menus, record.roles)
+
+        self.event_stats['received'] += 1
+        entry = self.entries.get((message_id, key))
+
+        # The role may have been deleted since the menu was posted
+        guild = self.bot.get_guild(entry[0]) if entry else None
+        if not (guild and guild.get_role(entry[1])):
+            self.event_stats['dropped'] += 1
+            return None
+
+        return entry
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        entry = await self.lookup(payload.guild_id, payload.message_id, emojiKey(payload.emoji))
+        if not entry or payload.user_id == self.bot.user.id: return
+        if payload.member and payload.member.bot: return
+
+        # The member's roles come with the event, so with the members intent several changes can be applied as one
+        # member edit
+        roles = [role.id for role in payload.member.roles if not role.is_default()] if payload.member else None
+        self.updates.add(entry[0], payload.user_id, entry[1], roles)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        entry = await self.lookup(payload.guild_id, payload.message_id, emojiKey(payload.emoji))
+        if not entry or payload.user_id == self.bot.user.id: return
+
+        self.updates.remove(entry[0], payload.user_id, entry[1])
+
+    # Button clicks arrive as raw INTERACTION_CREATE events, see LimitedRequests.on_socket_response
+    @commands.Cog.listener()
+    async def on_socket_response(self, msg):
+        if msg.get('t') != 'INTERACTION_CREATE': return
+
+        interaction = msg['d']
+        if interaction.get('type') != components.MESSAGE_COMPONENT or 'guild_id' not in interaction: return
+
+        custom_id = interaction['data'].get('custom_id', '').split(':', 1)
+        if len(custom_id) != 2 or custom_id[0] != 'rolemenu': return
+
+        entry = await self.lookup(int(interaction['guild_id']), int(interaction['message']['id']), custom_id[1])
+        if not entry:
+            return await self.bot.outbound.call(outbound.INTERACTIVE, 'interaction',
+                lambda: components.replyEphemeral(self.bot.http, interaction, 'This role is no longer on the menu.'))
+
+        guild_id, role_id = entry
+        member = interaction['member']
+        joined = self.updates.toggle(guild_id, int(member['user']['id']), role_id, [int(r) for r in member['roles']])
+
+        role = self.bot.get_guild(guild_id).get_role(role_id)
+        await self.bot.outbound.call(outbound.INTERACTIVE, 'interaction', lambda: components.replyEphemeral(
+            self.bot.http, interaction, f'You {"joined" if joined else "left"} the role "{role.name}".'))
+
+    # Fired by the role command in core.py when a role's requestable type changes; only open roles stay on menus
+    @commands.Cog.listener()
+    async def on_requestable_role_update(self, guild, role_id):
+        record = await utils.getGuildRecord(self.bot, guild)
+        if record: self.index_guild(record.id, record.menus, record.roles)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        if payload.message_id in self.menu_keys:
+            await self.menu_discard(payload.guild_id, [payload.message_id])
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        message_ids = [message_id for message_id in payload.message_ids if message_id in self.menu_keys]
+        if message_ids: await self.menu_discard(payload.guild_id, message_ids)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        for message_id in list(self.guild_menus.get(guild.id, ())):
+            self.unindex_menu(guild.id, message_id)
+
+    # Forgets menus whose message was deleted
+    async def menu_discard(self, guild_id, message_ids):
+        for message_id in message_ids:
+            self.unindex_menu(guild_id, message_id)
+
+        guild = self.bot.get_guild(guild_id)
+        record = await utils.getGuildRecord(self.bot, guild) if guild else None
+        if not record: return
+
+        for message_id in message_ids:
+            record.remove_menu(message_id)
+        await utils.saveGuild(self.bot, record)
+
+    @commands.group(name='rolemenu', aliases=['rolemenus'], invoke_without_command=True, case_insensitive=True)
+    @commands.has_guild_permissions(manage_roles=True)
+    @commands.guild_only()
+    @utils.guild_in_db()
+    async def _rolemenu(self, ctx):
+        '''
+        Lists the role menus of the guild
+
+        Role menus are messages that members react to, or click the buttons of, to join or leave open roles without
+        using commands.
+        '''
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+
+        if not record.menus:
+            return await utils.cmdFail(ctx, f'This server does not have any role menus. (Use the ' +
+                f'`{ctx.prefix}rolemenu create` command to post one.)')
+
+        lines = [f'https://discord.com/channels/{ctx.guild.id}/{menu["channel"]}/{message_id} (`{message_id}`) ' +
+            ' '.join(entry['emoji'] for entry in menu['entries']) for message_id, menu in record.menus.items()]
+        return await utils.sendListEmbed(ctx, 'Role Menus', lines,
+            footer=f'Use the "{ctx.prefix}help rolemenu" command for help on managing role menus.')
+
+    @_rolemenu.command(name='create', usage='<channel> <emoji> <role> [<emoji> <role>...]')
+    @commands.has_guild_permissions(manage_roles=True)
+    @commands.bot_has_guild_permissions(manage_roles=True)
+    @commands.guild_only()
+    @utils.guild_in_db()
+    async def _rolemenu_create(self, ctx, channel: discord.TextChannel, *entries):
+        '''
+        Posts a role menu for open roles
+
+        Each role follows the emoji used to join it, e.g. "rolemenu create #roles 🍎 @Red 🍐 @Green". The menu has a
+        button for every role, or a reaction if buttons are disabled.
+        '''
+        if not entries or len(entries) % 2:
+            return await utils.cmdFail(ctx, f'Give the roles of the menu as emoji and role pairs, e.g. ' +
+                f'`{ctx.prefix}rolemenu create #{channel} 🍎 @Red 🍐 @Green`.')
+
+        if len(entries) // 2 > ROLEMENU_MAX_ENTRIES:
+            return await utils.cmdFail(ctx, f'A role menu can have at most {ROLEMENU_MAX_ENTRIES} roles.')
+
+        index = await utils.getRoleIndex(ctx.bot, ctx.guild)
+        menu_entries = []
+        roles = []
+
+        for emoji, argument in zip(entries[::2], entries[1::2]):
+            role = await commands.RoleConverter().convert(ctx, argument)
+            match = components.CUSTOM_EMOJI.fullmatch(emoji)
+
+            if match:
+                emoji = f'<{match.group(1)}:{match.group(2)}:{match.group(3)}>'
+            elif emoji.isascii():
+                return await utils.cmdFail(ctx, f'"{emoji}" is not an emoji.')
+
+            if not index or index.get(role.id) != 'open':
+                return await utils.cmdFail(ctx, f'"{role.name}" is not an open role. Only open roles can be on a ' +
+                    'role menu, limited roles have to be requested.')
+
+            if any(emojiKey(entry['emoji']) == emojiKey(emoji) for entry in menu_entries):
+                return await utils.cmdFail(ctx, f'{emoji} is used for more than one role.')
+
+            menu_entries.append({ 'emoji': emoji, 'role': role.id })
+            roles.append(role)
+
+        buttons = getattr(config, 'rolemenu_buttons', True)
+        embed = discord.Embed(title='Role Menu',
+            description='\n'.join(f'{entry["emoji"]} <@&{entry["role"]}>' for entry in menu_entries))
+        embed.set_footer(text='Click a button to join or leave a role.' if buttons else
+            'React to join a role, remove your reaction to leave it.')
+
+        # Buttons are part of the message, saving a reaction call per role
+        if buttons:
+            rows = [components.button(f'rolemenu:{emojiKey(entry["emoji"])}', role.name[:80], components.SECONDARY,
+                entry['emoji']) for entry, role in zip(menu_entries, roles)]
+            data = await self.bot.outbound.call(outbound.INTERACTIVE, 'send', lambda: components.sendMessage(
+                self.bot.http, channel.id, embed=embed,
+                components=[components.actionRow(*rows[i:i + 5]) for i in range(0, len(rows), 5)]))
+            message_id = int(data['id'])
+        else:
+            message = await self.bot.outbound.call(outbound.INTERACTIVE, 'send', lambda: channel.send(embed=embed))
+            for entry in menu_entries:
+                await self.bot.outbound.submit(outbound.EMBED, 'reaction',
+                    lambda emoji=entry['emoji']: message.add_reaction(emoji))
+            message_id = message.id
+
+        menu = { 'channel': channel.id, 'buttons': buttons, 'entries': menu_entries }
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+        record.set_menu(message_id, menu)
+        await utils.saveGuild(ctx.bot, record)
+        self.index_menu(ctx.guild.id, message_id, menu, record.roles)
+
+        return await utils.cmdSuccess(ctx, f'Posted a role menu with {len(menu_entries)} ' +
+            f'role{"s" if len(menu_entries) > 1 else ""} in {channel}.')
+
+    @_rolemenu.command(name='remove', aliases=['delete', 'del'])
+    @commands.has_guild_permissions(manage_roles=True)
+    @commands.guild_only()
+    @utils.guild_in_db()
+    async def _rolemenu_remove(self, ctx, message_id: int):
+        '''Removes a role menu and deletes its message'''
+        record = await utils.getGuildRecord(ctx.bot, ctx.guild)
+        menu = record.menus.get(message_id)
+
+        if not menu:
+            return await utils.cmdFail(ctx, f'`{message_id}` is not a role menu of this server.')
+
+        record.remove_menu(message_id)
+        await utils.saveGuild(ctx.bot, record)
+        self.unindex_menu(ctx.guild.id, message_id)
+
+        channel = ctx.guild.get_channel(menu['channel'])
+        if channel: ctx.bot.deletions.schedule(channel, message_id)
+
+        return await utils.cmdSuccess(ctx, f'The role menu `{message_id}` has been removed.')
+
+def setup(bot):
+    bot.add_cog(RoleMenus(bot))
+    logging.info('[Extension] Role menu module loaded')
+
+def teardown(bot):
+    bot.remove_cog('RoleMenus')
+    logging.info('[Extension] Role menu module unloaded')
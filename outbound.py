@@ -0,0 +1,147 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+# Priority classes, most urgent first
+INTERACTIVE = 0 # Command replies
+ROLE = 1        # Role grants and removals
+EMBED = 2       # Request embed edits, reactions and message deletions
+DM = 3          # Direct messages
+
+PRIORITY_NAMES = { INTERACTIVE: 'interactive', ROLE: 'role', EMBED: 'embed', DM: 'dm' }
+
+class OutboundScheduler:
+    '''
+    Central scheduler for outbound Discord REST calls
+
+    Calls are queued per route (e.g. 'send', 'dm') and run by a fixed pool of workers. Each route has its own
+    concurrency limit, and workers only take calls from routes with a free slot, most urgent priority class first, so
+    command replies never wait behind a wave of slow or ratelimited DMs. Each priority class can have a limit on how
+    many calls may be queued or running at once; callers beyond it wait before enqueueing, which pushes back on
+    whatever is producing the work.
+
+    Calls are passed as zero-argument functions returning a coroutine, e.g. lambda: ctx.send(text).
+    '''
+    def __init__(self, *, workers=8, route_limits=None, default_route_limit=4, max_pending=None):
+        self.workers = workers
+        self.route_limits = route_limits or {}
+        self.default_route_limit = default_route_limit
+
+        self.queues = {} # route -> heap of (priority, sequence, factory, future, enqueued)
+        self.running = collections.Counter() # route -> calls in progress
+        self.wakeup = asyncio.Event() # Set when a call is queued or a route slot frees up
+        self.pending = { p: asyncio.Semaphore(limit) for p, limit in (max_pending or {}).items() }
+        self.sequence = itertools.count()
+        self.tasks = []
+
+        self.depth = collections.Counter()
+        self.completed = collections.Counter()
+        self.failed = collections.Counter()
+        self.wait_time = collections.Counter()
+        self.max_wait_time = collections.Counter()
+        self.route_calls = collections.Counter()
+
+    def start(self, loop):
+        self.tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks: task.cancel()
+        self.tasks = []
+
+    # Calls queued and not yet started
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    # Queues the call and waits for its result
+    async def call(self, priority, route, factory):
+        return await (await self._enqueue(priority, route, factory))
+
+    # Queues the call without waiting for it, e.g. DMs, and returns its future; failures are logged. Like call, it
+    # waits while the priority class is at its max_pending limit, so producers of background work are held back.
+    async def submit(self, priority, route, factory):
+        future = await self._enqueue(priority, route, factory)
+        future.add_done_callback(self._log_failure(route))
+        return future
+
+    async def _enqueue(self, priority, route, factory):
+        if priority in self.pending: await self.pending[priority].acquire()
+
+        future = asyncio.get_event_loop().create_future()
+        self.depth[priority] += 1
+        heapq.heappush(self.queues.setdefault(route, []),
+            (priority, next(self.sequence), factory, future, time.perf_counter()))
+        self.wakeup.set()
+
+        return future
+
+    def stats(self):
+        stats = {}
+
+        for p, name in PRIORITY_NAMES.items():
+            stats[name] = {
+                'queued': self.depth[p],
+                'completed': self.completed[p],
+                'failed': self.failed[p],
+                'avg_wait': self.wait_time[p] / self.completed[p] if self.completed[p] else 0.0,
+                'max_wait': self.max_wait_time[p]
+            }
+
+        stats['routes'] = dict(self.route_calls)
+        return stats
+
+    # Takes the most urgent call of the routes that have a free slot, or returns None
+    def _next(self):
+        best = None
+
+        for route, queue in self.queues.items():
+            if queue and self.running[route] < self.route_limits.get(route, self.default_route_limit):
+                if best is None or queue[0] < self.queues[best][0]: best = route
+
+        if best is None: return None
+
+        self.running[best] += 1
+        return (best,) + heapq.heappop(self.queues[best])
+
+    async def _worker(self):
+        while True:
+            item = self._next()
+
+            if item is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            route, priority, _, factory, future, enqueued = item
+
+            try:
+                waited = time.perf_counter() - enqueued
+                self.depth[priority] -= 1
+                self.wait_time[priority] += waited
+                self.max_wait_time[priority] = max(self.max_wait_time[priority], waited)
+
+                if future.cancelled(): continue
+
+                self.route_calls[route] += 1
+
+                try:
+                    result = await factory()
+                except Exception as e:
+                    self.failed[priority] += 1
+                    if not future.cancelled(): future.set_exception(e)
+                else:
+                    if not future.cancelled(): future.set_result(result)
+                finally:
+                    self.completed[priority] += 1
+            finally:
+                self.running[route] -= 1
+                self.wakeup.set()
+                if priority in self.pending: self.pending[priority].release()
+
+    def _log_failure(self, route):
+        def callback(future):
+            if not future.cancelled() and future.exception():
+                logging.info(f'[Outbound] Background {route} call failed: {future.exception()}')
+        return callback
@@ -0,0 +1,78 @@
+import collections
+
+from consts import *
+
+class RatelimitBucket:
+    __slots__ = ('entries', 'scores', 'total')
+
+    def __init__(self):
+        self.entries = collections.deque() # (created, message id), oldest first
+        self.scores = {}                   # message id -> current score
+        self.total = 0
+
+class Ratelimiter:
+    '''
+    Sliding-window limited request scores per (guild, user)
+
+    Each request contributes the LIMITED_RATELIMIT_SCORES score of its current status until it falls out of the
+    window. Scores older than the window are evicted from the front of the bucket whenever it is read, so checking
+    a user never looks at stored requests.
+    '''
+    def __init__(self):
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def record(self, guild_id, user_id, message_id, created, status):
+        bucket = self.buckets.setdefault((guild_id, user_id), RatelimitBucket())
+        message_id = int(message_id)
+
+        if message_id in bucket.scores:
+            return self.update(guild_id, user_id, message_id, status)
+
+        # Requests are recorded in creation order, except while rebuilding from storage
+        if bucket.entries and created < bucket.entries[-1][0]:
+            bucket.entries.append((created, message_id))
+            bucket.entries = collections.deque(sorted(bucket.entries))
+        else:
+            bucket.entries.append((created, message_id))
+
+        bucket.scores[message_id] = LIMITED_RATELIMIT_SCORES.get(status, 0)
+        bucket.total += bucket.scores[message_id]
+
+    def update(self, guild_id, user_id, message_id, status):
+        bucket = self.buckets.get((guild_id, user_id))
+        message_id = int(message_id)
+        if not bucket or message_id not in bucket.scores: return
+
+        score = LIMITED_RATELIMIT_SCORES.get(status, 0)
+        bucket.total += score - bucket.scores[message_id]
+        bucket.scores[message_id] = score
+
+    # Score of the user's requests created after since (a timestamp)
+    def score(self, guild_id, user_id, since):
+        bucket = self.buckets.get((guild_id, user_id))
+        if not bucket: return 0
+
+        self._evict(bucket, since)
+
+        if not bucket.entries:
+            del self.buckets[(guild_id, user_id)]
+            return 0
+
+        return bucket.total
+
+    # Drops every score created before since; used to bound memory for users that never come back
+    def prune(self, since):
+        for key in list(self.buckets):
+            self._evict(self.buckets[key], since)
+            if not self.buckets[key].entries: del self.buckets[key]
+
+    def clear(self):
+        self.buckets.clear()
+
+    def _evict(self, bucket, since):
+        while bucket.entries and bucket.entries[0][0] < since:
+            _, message_id = bucket.entries.popleft()
+            bucket.total -= bucket.scores.pop(message_id)
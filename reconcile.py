@@ -0,0 +1,68 @@
+import logging
+import time
+
+import utils
+
+# Diffs the guilds on this process' shards against the gateway cache in a single pass and applies every cleanup as
+# one batched write: guilds the bot is no longer in are removed, and requestable roles and limited requests whose
+# role, channel or (pending) requester disappeared while the bot was offline are deleted. Unavailable guilds are left
+# alone. Documents are read a chunk at a time on a storage worker thread, so the scan yields to the event loop in
+# between chunks.
+async def reconcile(bot):
+    timings = {}
+    start = time.perf_counter()
+
+    ops = []
+    touched = set()
+    removed_guilds = removed_roles = removed_requests = skipped_guilds = 0
+
+    async for doc in bot.db.docs(lambda guild_id: utils.ownsGuild(bot, guild_id)):
+        guild = bot.get_guild(doc['id'])
+
+        if not guild:
+            ops.append(('remove', doc['id']))
+            removed_guilds += 1
+            continue
+
+        # Guilds that are unavailable during an outage come as stubs without roles or channels, so nothing in them
+        # can be told apart from what was really deleted
+        if guild.unavailable or not guild.roles or not guild.channels:
+            skipped_guilds += 1
+            continue
+
+        for role_id in doc['roles']:
+            if not guild.get_role(int(role_id)):
+                ops.append(('delete', guild.id, f'roles.{role_id}'))
+                touched.add(guild.id)
+                removed_roles += 1
+
+        for message_id, request in doc['requests'].items():
+            orphaned = (not guild.get_channel(request['channel']) or not guild.get_role(request['role']) or
+                # Members are only known to be gone if the guild's member list has been fully received
+                (request['status'] == 'pending' and guild.chunked and not guild.get_member(request['user'])))
+
+            if orphaned:
+                ops.append(('delete', guild.id, f'requests.{message_id}'))
+                touched.add(guild.id)
+                removed_requests += 1
+
+    timings['scan'] = time.perf_counter() - start
+
+    write_start = time.perf_counter()
+    if ops:
+        await bot.db.apply(ops)
+
+        for op in ops:
+            if op[0] == 'remove':
+                bot.guild_cache.put(op[1], None)
+        for guild_id in touched:
+            bot.guild_cache.invalidate(guild_id)
+
+    timings['write'] = time.perf_counter() - write_start
+    timings['total'] = time.perf_counter() - start
+
+    logging.info(f'[Bot] Reconciled database: removed {removed_guilds} guilds, {removed_roles} roles and ' +
+        f'{removed_requests} requests, skipped {skipped_guilds} unavailable guilds (scan {timings["scan"]:.3f}s, ' +
+        f'write {timings["write"]:.3f}s)')
+
+    return timings
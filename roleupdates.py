@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+from consts import *
+from locks import KeyedLock
+import outbound
+
+class PendingUpdate:
+    __slots__ = ('changes', 'roles')
+
+    def __init__(self):
+        self.changes = {} # role id -> True to add, False to remove; the last change of a role wins
+        self.roles = None # Role ids the member had in the most recent event, if the event carried them
+
+class RoleUpdateCoalescer:
+    '''
+    Applies role changes per member, coalescing the changes made within window seconds of the first one
+
+    A single change is applied with an atomic add or remove. Several changes are applied as one member edit with the
+    member's complete role list, which is only done with members_intent, when the roles carried by the events are kept
+    current, and if one of the events carried them; otherwise every change gets its own call, so roles changed
+    elsewhere meanwhile aren't overwritten. Changes that cancel out, or that the member's roles already reflect, aren't
+    sent.
+
+    Gateway events can arrive before the member's roles reflect an update that was just applied, so applied changes
+    are laid over the roles of later events for ROLEMENU_SETTLE seconds, and a member's updates are applied one at a
+    time. Calls go through the outbound scheduler's 'roles' route.
+    '''
+    def __init__(self, scheduler, http, *, window=ROLEMENU_COALESCE_WINDOW, reason=None, members_intent=False):
+        self.scheduler = scheduler
+        self.http = http
+        self.window = window
+        self.reason = reason
+        self.members_intent = members_intent
+        self.pending = {} # (guild id, user id) -> PendingUpdate waiting for the window to close
+        self.applied = {} # (guild id, user id) -> (settled at, changes) of the member's last update
+        self.locks = KeyedLock()
+
+        self.changes = 0
+        self.calls = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def add(self, guild_id, user_id, role_id, roles=None):
+        self._change(guild_id, user_id, role_id, True, roles)
+
+    def remove(self, guild_id, user_id, role_id, roles=None):
+        self._change(guild_id, user_id, role_id, False, roles)
+
+    # Adds the role if the member doesn't have it, counting changes that are still pending, and removes it otherwise;
+    # roles are the member's role ids as of the event
+    def toggle(self, guild_id, user_id, role_id, roles):
+        update = self.pending.get((guild_id, user_id))
+        has_role = role_id in self._overlay((guild_id, user_id), roles)
+        if update and role_id in update.changes: has_role = update.changes[role_id]
+
+        self._change(guild_id, user_id, role_id, not has_role, roles)
+        return not has_role
+
+    def _change(self, guild_id, user_id, role_id, add, roles):
+        key = (guild_id, user_id)
+        update = self.pending.get(key)
+
+        if update is None:
+            update = self.pending[key] = PendingUpdate()
+            asyncio.get_event_loop().call_later(self.window, self._close, key)
+
+        if roles is not None: update.roles = set(roles)
+        update.changes[role_id] = add
+        self.changes += 1
+
+    def _close(self, key):
+        update = self.pending.pop(key)
+        asyncio.ensure_future(self.apply(key, update)).add_done_callback(self._log_failure)
+
+    # The member's roles with their last update applied, unless it has settled
+    def _overlay(self, key, roles):
+        if roles is None: return None
+
+        applied = self.applied.get(key)
+        if not applied: return set(roles)
+
+        if applied[0] < time.monotonic():
+            del self.applied[key]
+            return set(roles)
+
+        return { role_id for role_id in roles if applied[1].get(role_id, True) } | \
+            { role_id for role_id, add in applied[1].items() if add }
+
+    async def apply(self, key, update):
+        guild_id, user_id = key
+
+        async with self.locks.hold(key):
+            roles = self._overlay(key, update.roles)
+            changes = { role_id: add for role_id, add in update.changes.items()
+                if roles is None or (role_id in roles) != add }
+
+            self.skipped += len(update.changes) - len(changes)
+            if not changes: return
+
+            # Changes of an earlier update that hasn't settled yet stay in the overlay
+            now = time.monotonic()
+            earlier = self.applied.get(key)
+            applied = self.applied[key] = (now + ROLEMENU_SETTLE,
+                { **earlier[1], **changes } if earlier and earlier[0] >= now else changes)
+            asyncio.get_event_loop().call_later(ROLEMENU_SETTLE, self._settle, key, applied)
+
+            if len(changes) > 1 and roles is not None and self.members_intent:
+                final = { role_id for role_id in roles if changes.get(role_id, True) } | \
+                    { role_id for role_id, add in changes.items() if add }
+
+                self.calls += 1
+                try:
+                    await self.scheduler.call(outbound.ROLE, 'roles', lambda: self.http.edit_member(guild_id, user_id,
+                        roles=[str(role_id) for role_id in final], reason=self.reason))
+                except discord.HTTPException as e:
+                    self._failed(key, len(changes), e)
+                return
+
+            results = await asyncio.gather(*(self._apply_one(guild_id, user_id, role_id, add)
+                for role_id, add in changes.items()), return_exceptions=True)
+
+            errors = [result for result in results if isinstance(result, Exception)]
+            if errors: self._failed(key, len(errors), errors[0])
+
+    async def _apply_one(self, guild_id, user_id, role_id, add):
+        self.calls += 1
+        method = self.http.add_role if add else self.http.remove_role
+        await self.scheduler.call(outbound.ROLE, 'roles',
+            lambda: method(guild_id, user_id, role_id, reason=self.reason))
+
+    def _failed(self, key, count, error):
+        self.failed += count
+        self.applied.pop(key, None)
+        logging.info(f'[Outbound] Unable to update the roles of member {key[1]} in {key[0]}: {error}')
+
+    # Drops the member's last update once settled, unless a newer one replaced it
+    def _settle(self, key, applied):
+        if self.applied.get(key) is applied: del self.applied[key]
+
+    def stats(self):
+        return {
+            'changes': self.changes,
+            'pending': len(self.pending),
+            'calls': self.calls,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'calls_saved': self.changes - self.calls
+        }
+
+    def _log_failure(self, task):
+        if not task.cancelled() and task.exception():
+            logging.info(f'[Outbound] Coalesced role update failed: {task.exception()}')
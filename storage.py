@@ -0,0 +1,454 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import dict_deep
+from tinydb import Query, TinyDB
+
+from models import Status
+
+Servers = Query()
+
+REQUEST_STATUSES = tuple(status.value for status in Status)
+ROLE_TYPES = ('open', 'limited')
+
+# The document a guild starts with, see utils.guild_in_db and models.GuildRecord
+def defaultGuildDoc(guild_id):
+    return {
+        'id': guild_id,
+        'requests_opts': {
+            'channel': None,
+            'hidejoins': False,
+            'ratelimit': True
+        },
+        'requests': {},
+        'roles': {}
+    }
+
+class Storage:
+    '''
+    Interface between the guild document helpers in utils.py and a storage engine
+
+    Guild documents look like the default document from defaultGuildDoc. Keys passed to set and delete are
+    dotted paths into a guild document, e.g. 'requests.<message id>.status'.
+
+    Engines with concurrent_reads can be read from several threads at once, as long as nothing is written meanwhile;
+    see asyncstorage.AsyncStorage.
+    '''
+    concurrent_reads = False
+
+    def get(self, guild_id):
+        raise NotImplementedError
+
+    def contains(self, guild_id):
+        return self.get(guild_id) is not None
+
+    def insert(self, doc):
+        raise NotImplementedError
+
+    def set(self, guild_id, key, val):
+        raise NotImplementedError
+
+    def delete(self, guild_id, key):
+        raise NotImplementedError
+
+    def remove(self, guild_id):
+        raise NotImplementedError
+
+    def __iter__(self):
+        raise NotImplementedError
+
+    # Iterates the documents of the guilds for which owns(guild_id) is true, e.g. those on this process' shards
+    def docs(self, owns=None):
+        return (doc for doc in self if owns is None or owns(doc['id']))
+
+    # Applies a batch of operations, e.g. ('set', guild_id, key, val), ('delete', guild_id, key), ('insert', doc) or
+    # ('remove', guild_id). Engines override this to commit the whole batch in a single write.
+    def apply(self, ops):
+        for op in ops:
+            getattr(self, op[0])(*op[1:])
+
+    def close(self):
+        pass
+
+class TinyDBStorage(Storage):
+    '''Stores every guild document in a single JSON file, rewritten in full on each change'''
+    def __init__(self, path):
+        self.path = path
+        self.db = TinyDB(path)
+
+    def get(self, guild_id):
+        return self.db.get(Servers.id == guild_id)
+
+    def contains(self, guild_id):
+        return self.db.contains(Servers.id == guild_id)
+
+    # Replaces any existing document for the guild, so replaying an insert is harmless
+    def insert(self, doc):
+        self.db.remove(Servers.id == doc['id'])
+        return self.db.insert(doc)
+
+    def set(self, guild_id, key, val):
+        def transform(doc):
+            dict_deep.deep_set(doc, key, val)
+
+        return self.db.update(transform, Servers.id == guild_id)
+
+    def delete(self, guild_id, key):
+        def transform(doc):
+            dict_deep.deep_del(doc, key)
+
+        return self.db.update(transform, Servers.id == guild_id)
+
+    def remove(self, guild_id):
+        return self.db.remove(Servers.id == guild_id)
+
+    def __iter__(self):
+        return iter(self.db)
+
+    # Runs of set/delete operations are written with a single update_multiple call, and runs of inserts with a single
+    # remove and insert_multiple call, i.e. one rewrite of the file per run
+    def apply(self, ops):
+        updates = []
+        inserts = []
+
+        for op in ops:
+            if op[0] in ('set', 'delete'):
+                if inserts: inserts = self._insert_multiple(inserts)
+                updates.append((self._transform(*op), Servers.id == op[1]))
+                continue
+
+            if updates:
+                self.db.update_multiple(updates)
+                updates = []
+
+            if op[0] == 'insert':
+                inserts.append(op[1])
+                continue
+
+            if inserts: inserts = self._insert_multiple(inserts)
+            getattr(self, op[0])(*op[1:])
+
+        if updates:
+            self.db.update_multiple(updates)
+        if inserts:
+            self._insert_multiple(inserts)
+
+    def _insert_multiple(self, docs):
+        docs = list({ doc['id']: doc for doc in docs }.values()) # Last insert of a guild wins, as with insert
+        self.db.remove(Servers.id.one_of([doc['id'] for doc in docs]))
+        self.db.insert_multiple(docs)
+        return []
+
+    def _transform(self, action, guild_id, key, val=None):
+        def transform(doc):
+            if action == 'set':
+                dict_deep.deep_set(doc, key, val)
+            else:
+                dict_deep.deep_del(doc, key)
+        return transform
+
+    def close(self):
+        self.db.close()
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS guilds (
+    id INTEGER PRIMARY KEY,
+    requests_opts TEXT NOT NULL,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS roles (
+    guild_id INTEGER NOT NULL,
+    role_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    PRIMARY KEY (guild_id, role_id)
+);
+CREATE TABLE IF NOT EXISTS requests (
+    message_id INTEGER PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    channel INTEGER,
+    created REAL NOT NULL,
+    role INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    user INTEGER NOT NULL,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS roles_guild ON roles (guild_id);
+CREATE INDEX IF NOT EXISTS requests_guild ON requests (guild_id);
+CREATE INDEX IF NOT EXISTS requests_guild_user ON requests (guild_id, user);
+'''
+
+REQUEST_COLUMNS = ('channel', 'created', 'role', 'status', 'user')
+
+class SQLiteStorage(Storage):
+    '''
+    Stores guild documents in an indexed SQLite database in WAL mode
+
+    Guild options, requestable roles and limited requests each have their own table, so updating a single role or
+    request only touches its own row. Top-level document keys the schema doesn't know about are kept as JSON in
+    guilds.extra, and unknown request fields in requests.extra.
+
+    Writes go through a single connection. Reads use a connection per thread, so they can run concurrently.
+    '''
+    concurrent_reads = True
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SQLITE_SCHEMA)
+
+        self.local = threading.local()
+        self.readers = []
+
+    # The calling thread's read connection
+    def reader(self):
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self.readers.append(conn)
+
+        return conn
+
+    def get(self, guild_id):
+        conn = self.reader()
+        row = conn.execute('SELECT requests_opts, extra FROM guilds WHERE id = ?', (guild_id,)).fetchone()
+        if not row: return None
+
+        doc = json.loads(row[1])
+        doc.update({
+            'id': guild_id,
+            'requests_opts': json.loads(row[0]),
+            'requests': {},
+            'roles': {}
+        })
+
+        for role_id, role_type in conn.execute('SELECT role_id, type FROM roles WHERE guild_id = ?', (guild_id,)):
+            doc['roles'][str(role_id)] = { 'type': role_type }
+
+        for row in conn.execute('SELECT message_id, extra, ' + ', '.join(REQUEST_COLUMNS) +
+            ' FROM requests WHERE guild_id = ? ORDER BY message_id', (guild_id,)):
+            doc['requests'][str(row[0])] = self._request_from_row(row[1:])
+
+        return doc
+
+    def contains(self, guild_id):
+        return self.reader().execute('SELECT 1 FROM guilds WHERE id = ?', (guild_id,)).fetchone() is not None
+
+    def insert(self, doc):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self._insert(doc)
+        return doc['id']
+
+    def set(self, guild_id, key, val):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self._set(guild_id, key.split('.'), val)
+
+    def delete(self, guild_id, key):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self._delete(guild_id, key.split('.'))
+
+    def remove(self, guild_id):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self._remove(guild_id)
+
+    def apply(self, ops):
+        with self.conn:
+            self.conn.execute('BEGIN')
+
+            for op in ops:
+                if op[0] == 'set':
+                    self._set(op[1], op[2].split('.'), op[3])
+                elif op[0] == 'delete':
+                    self._delete(op[1], op[2].split('.'))
+                elif op[0] == 'insert':
+                    self._insert(op[1])
+                elif op[0] == 'remove':
+                    self._remove(op[1])
+
+    def __iter__(self):
+        return self.docs()
+
+    # Only loads the documents of owned guilds
+    def docs(self, owns=None):
+        guild_ids = [row[0] for row in self.reader().execute('SELECT id FROM guilds ORDER BY id')]
+
+        for guild_id in guild_ids:
+            if owns and not owns(guild_id): continue
+
+            doc = self.get(guild_id)
+            if doc: yield doc
+
+    def close(self):
+        for conn in self.readers:
+            conn.close()
+        self.conn.close()
+
+    def _request_from_row(self, row):
+        request = json.loads(row[0])
+        request.update(zip(REQUEST_COLUMNS, row[1:]))
+        return request
+
+    def _request_to_row(self, request):
+        extra = {k: v for k, v in request.items() if k not in REQUEST_COLUMNS}
+        return [request.get(column) for column in REQUEST_COLUMNS] + [json.dumps(extra)]
+
+    def _insert(self, doc):
+        extra = {k: v for k, v in doc.items() if k not in ('id', 'requests_opts', 'requests', 'roles')}
+
+        self.conn.execute('INSERT OR REPLACE INTO guilds (id, requests_opts, extra) VALUES (?, ?, ?)',
+            (doc['id'], json.dumps(doc['requests_opts']), json.dumps(extra)))
+
+        self.conn.execute('DELETE FROM roles WHERE guild_id = ?', (doc['id'],))
+        self.conn.execute('DELETE FROM requests WHERE guild_id = ?', (doc['id'],))
+
+        for role_id, role in doc['roles'].items():
+            self._set_role(doc['id'], role_id, role)
+        for message_id, request in doc['requests'].items():
+            self._set_request(doc['id'], message_id, request)
+
+    def _remove(self, guild_id):
+        self.conn.execute('DELETE FROM guilds WHERE id = ?', (guild_id,))
+        self.conn.execute('DELETE FROM roles WHERE guild_id = ?', (guild_id,))
+        self.conn.execute('DELETE FROM requests WHERE guild_id = ?', (guild_id,))
+
+    def _set_role(self, guild_id, role_id, role):
+        self.conn.execute('INSERT OR REPLACE INTO roles (guild_id, role_id, type) VALUES (?, ?, ?)',
+            (guild_id, int(role_id), role['type']))
+
+    def _set_request(self, guild_id, message_id, request):
+        self.conn.execute('INSERT OR REPLACE INTO requests (message_id, guild_id, ' + ', '.join(REQUEST_COLUMNS) +
+            ', extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [int(message_id), guild_id] + self._request_to_row(request))
+
+    # Updates a single key of the guilds.extra/requests_opts JSON columns
+    def _set_json(self, guild_id, column, path, val, *, delete=False):
+        row = self.conn.execute(f'SELECT {column} FROM guilds WHERE id = ?', (guild_id,)).fetchone()
+        if not row: return
+
+        data = json.loads(row[0])
+        if delete:
+            dict_deep.deep_del(data, '.'.join(path))
+        else:
+            dict_deep.deep_set(data, '.'.join(path), val)
+
+        self.conn.execute(f'UPDATE guilds SET {column} = ? WHERE id = ?', (json.dumps(data), guild_id))
+
+    def _set(self, guild_id, path, val):
+        top = path[0]
+
+        if top == 'requests_opts':
+            if len(path) == 1:
+                self.conn.execute('UPDATE guilds SET requests_opts = ? WHERE id = ?', (json.dumps(val), guild_id))
+            else:
+                self._set_json(guild_id, 'requests_opts', path[1:], val)
+
+        elif top == 'roles':
+            if len(path) == 1:
+                self.conn.execute('DELETE FROM roles WHERE guild_id = ?', (guild_id,))
+                for role_id, role in val.items():
+                    self._set_role(guild_id, role_id, role)
+            elif len(path) == 2:
+                self._set_role(guild_id, path[1], val)
+            else:
+                self.conn.execute('UPDATE roles SET type = ? WHERE guild_id = ? AND role_id = ?',
+                    (val, guild_id, int(path[1])))
+
+        elif top == 'requests':
+            if len(path) == 1:
+                self.conn.execute('DELETE FROM requests WHERE guild_id = ?', (guild_id,))
+                for message_id, request in val.items():
+                    self._set_request(guild_id, message_id, request)
+            elif len(path) == 2:
+                self._set_request(guild_id, path[1], val)
+            elif path[2] in REQUEST_COLUMNS:
+                self.conn.execute(f'UPDATE requests SET {path[2]} = ? WHERE message_id = ? AND guild_id = ?',
+                    (val, int(path[1]), guild_id))
+            else:
+                row = self.conn.execute('SELECT extra FROM requests WHERE message_id = ?', (int(path[1]),)).fetchone()
+                if not row: return
+
+                extra = json.loads(row[0])
+                dict_deep.deep_set(extra, '.'.join(path[2:]), val)
+                self.conn.execute('UPDATE requests SET extra = ? WHERE message_id = ?',
+                    (json.dumps(extra), int(path[1])))
+
+        elif top != 'id':
+            self._set_json(guild_id, 'extra', path, val)
+
+    def _delete(self, guild_id, path):
+        top = path[0]
+
+        if top == 'requests_opts':
+            self._set_json(guild_id, 'requests_opts', path[1:], None, delete=True)
+
+        elif top == 'roles' and len(path) == 2:
+            self.conn.execute('DELETE FROM roles WHERE guild_id = ? AND role_id = ?', (guild_id, int(path[1])))
+
+        elif top == 'requests' and len(path) == 2:
+            self.conn.execute('DELETE FROM requests WHERE guild_id = ? AND message_id = ?', (guild_id, int(path[1])))
+
+        elif top == 'requests' and len(path) > 2 and path[2] not in REQUEST_COLUMNS:
+            row = self.conn.execute('SELECT extra FROM requests WHERE message_id = ?', (int(path[1]),)).fetchone()
+            if not row: return
+
+            extra = json.loads(row[0])
+            dict_deep.deep_del(extra, '.'.join(path[2:]))
+            self.conn.execute('UPDATE requests SET extra = ? WHERE message_id = ?', (json.dumps(extra), int(path[1])))
+
+        elif top not in ('id', 'roles', 'requests'):
+            self._set_json(guild_id, 'extra', path, None, delete=True)
+
+        else:
+            raise KeyError('.'.join(path))
+
+def migrate(json_path, sqlite_path):
+    '''Copies every guild document from a TinyDB JSON file into a SQLite database in a single transaction'''
+    source = TinyDBStorage(json_path)
+    target = SQLiteStorage(sqlite_path)
+    count = 0
+
+    with target.conn:
+        target.conn.execute('BEGIN')
+        for doc in source:
+            target._insert(doc)
+            count += 1
+
+    source.close()
+    target.close()
+
+    logging.info(f'[Storage] Migrated {count} guilds from {json_path} to {sqlite_path}')
+    return count
+
+def openStorage(engine='tinydb', path=None):
+    if engine == 'tinydb':
+        return TinyDBStorage(path or 'db.json')
+
+    if engine == 'sqlite':
+        path = path or 'db.sqlite3'
+
+        # One-shot migration the first time the bot is started with the SQLite engine
+        if not os.path.exists(path) and os.path.exists('db.json'):
+            migrate('db.json', path)
+
+        return SQLiteStorage(path)
+
+    raise ValueError(f'Unknown storage engine: {engine}')
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]: %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Migrates a RoleRequest TinyDB database to SQLite.')
+    parser.add_argument('source', nargs='?', default='db.json', help='TinyDB JSON file to read (default: db.json)')
+    parser.add_argument('target', nargs='?', default='db.sqlite3', help='SQLite file to write (default: db.sqlite3)')
+    args = parser.parse_args()
+
+    migrate(args.source, args.target)
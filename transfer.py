@@ -0,0 +1,189 @@
+'''
+Streaming export and import of guild documents as NDJSON
+
+Each guild is written as a 'guild' record (the document without its requests), followed by one 'request' record per
+limited request:
+
+    {"type": "guild", "id": 1234, "requests_opts": {...}, "roles": {"5678": {"type": "open"}}}
+    {"type": "request", "guild_id": 1234, "message_id": 9012, "channel": 3456, "created": 1600000000.0, ...}
+
+Only one guild document is held in memory at a time in either direction, and imports are written in batches through
+Storage.apply. Run `python transfer.py --help` for the command line interface.
+'''
+import argparse
+import contextlib
+import gzip
+import json
+import logging
+import sys
+
+from storage import REQUEST_STATUSES, ROLE_TYPES, defaultGuildDoc, openStorage
+
+IMPORT_BATCH_SIZE = 1000 # Records per Storage.apply call
+
+class RecordError(ValueError):
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+        self.line = line
+
+# Yields the records of the given guilds, or of every guild in the database
+def exportRecords(db, guild_ids=None):
+    docs = (db.get(guild_id) for guild_id in guild_ids) if guild_ids else db.docs()
+
+    for doc in docs:
+        if not doc: continue
+
+        guild = { k: v for k, v in doc.items() if k != 'requests' }
+        yield dict(guild, type='guild')
+
+        for message_id, request in doc['requests'].items():
+            yield dict(request, type='request', guild_id=doc['id'], message_id=int(message_id))
+
+def export(db, fp, guild_ids=None):
+    counts = { 'guild': 0, 'request': 0 }
+
+    for record in exportRecords(db, guild_ids):
+        fp.write(json.dumps(record) + '\n')
+        counts[record['type']] += 1
+
+    return counts['guild'], counts['request']
+
+def _isId(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+# Checks a guild record against the shape of defaultGuildDoc, raising RecordError
+def validateGuild(record, line):
+    if not _isId(record.get('id')):
+        raise RecordError(line, 'guild id must be a positive integer')
+
+    for key, default in defaultGuildDoc(0).items():
+        if key == 'requests': continue
+        if not isinstance(record.get(key), type(default)):
+            raise RecordError(line, f'guild {record["id"]}: {key} must be a {type(default).__name__}')
+
+    opts = record['requests_opts']
+    if not (opts['channel'] is None or _isId(opts['channel'])):
+        raise RecordError(line, f'guild {record["id"]}: requests_opts.channel must be a channel id or null')
+
+    for key, default in defaultGuildDoc(0)['requests_opts'].items():
+        if default is not None and not isinstance(opts.get(key), type(default)):
+            raise RecordError(line, f'guild {record["id"]}: requests_opts.{key} must be a {type(default).__name__}')
+
+    for role_id, role in record['roles'].items():
+        if not role_id.isdigit() or not isinstance(role, dict) or role.get('type') not in ROLE_TYPES:
+            raise RecordError(line, f'guild {record["id"]}: invalid requestable role {role_id}')
+
+def validateRequest(record, line):
+    for key in ('message_id', 'guild_id', 'role', 'user'):
+        if not _isId(record.get(key)):
+            raise RecordError(line, f'request {key} must be a positive integer')
+
+    if not (record.get('channel') is None or _isId(record['channel'])):
+        raise RecordError(line, f'request {record["message_id"]}: channel must be a channel id or null')
+    if not isinstance(record.get('created'), (int, float)) or isinstance(record['created'], bool):
+        raise RecordError(line, f'request {record["message_id"]}: created must be a timestamp')
+    if record.get('status') not in REQUEST_STATUSES:
+        raise RecordError(line, f'request {record["message_id"]}: unknown status {record.get("status")!r}')
+
+# Reads NDJSON records and writes each guild, with the requests following it, as one insert. Inserts are committed
+# IMPORT_BATCH_SIZE records at a time, or not at all with dry_run. Raises RecordError on the first invalid record;
+# batches before it have already been written.
+def importRecords(db, fp, *, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+    ops = []
+    pending_records = 0
+    doc = None
+    guilds = requests = 0
+
+    def commit():
+        nonlocal ops, pending_records
+        if ops and not dry_run: db.apply(ops)
+        ops = []
+        pending_records = 0
+
+    for line, text in enumerate(fp, 1):
+        if not text.strip(): continue
+
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            raise RecordError(line, f'invalid JSON ({e})')
+        if not isinstance(record, dict):
+            raise RecordError(line, 'record must be an object')
+
+        kind = record.pop('type', None)
+
+        if kind == 'guild':
+            validateGuild(record, line)
+            if doc: ops.append(('insert', doc))
+            if pending_records >= batch_size: commit()
+
+            doc = dict(record, requests={})
+            guilds += 1
+
+        elif kind == 'request':
+            validateRequest(record, line)
+            if not doc or doc['id'] != record['guild_id']:
+                raise RecordError(line, f'request {record["message_id"]} does not follow the record of guild ' +
+                    f'{record["guild_id"]}')
+
+            message_id = record.pop('message_id')
+            del record['guild_id']
+            doc['requests'][str(message_id)] = record
+            requests += 1
+
+        else:
+            raise RecordError(line, f'unknown record type {kind!r}')
+
+        pending_records += 1
+
+    if doc: ops.append(('insert', doc))
+    commit()
+
+    return guilds, requests
+
+def _open(path, mode):
+    if path == '-': return contextlib.nullcontext(sys.stdout if 'w' in mode else sys.stdin)
+    if path.endswith('.gz'): return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s]: %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Exports or imports the RoleRequest database as NDJSON.')
+    parser.add_argument('--engine', choices=('tinydb', 'sqlite'), default=None,
+        help='storage engine (default: config.storage, or tinydb)')
+    parser.add_argument('--path', default=None, help='database file (default: config.storage_path or the engine default)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='writes guilds and their requests as NDJSON')
+    export_parser.add_argument('output', nargs='?', default='-', help='file to write, .gz to compress (default: stdout)')
+    export_parser.add_argument('--guild', type=int, action='append', dest='guilds', help='only export this guild')
+
+    import_parser = subparsers.add_parser('import', help='loads NDJSON records, replacing existing guilds')
+    import_parser.add_argument('input', nargs='?', default='-', help='file to read, .gz if compressed (default: stdin)')
+    import_parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='records per write')
+    import_parser.add_argument('--check', action='store_true', help='only validate the records')
+    args = parser.parse_args()
+
+    try:
+        import config
+    except ImportError:
+        config = None
+
+    engine = args.engine or getattr(config, 'storage', 'tinydb')
+    db = openStorage(engine, args.path or getattr(config, 'storage_path', None))
+
+    try:
+        if args.command == 'export':
+            with _open(args.output, 'w') as f:
+                guilds, requests = export(db, f, args.guilds)
+            logging.info(f'[Storage] Exported {guilds} guilds and {requests} requests')
+        else:
+            with _open(args.input, 'r') as f:
+                guilds, requests = importRecords(db, f, batch_size=args.batch_size, dry_run=args.check)
+            logging.info(f'[Storage] {"Checked" if args.check else "Imported"} {guilds} guilds and {requests} requests')
+    except RecordError as e:
+        logging.error(f'[Storage] Invalid record, stopped at {e}')
+        sys.exit(1)
+    finally:
+        db.close()
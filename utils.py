@@ -1,23 +1,31 @@
-import io
+import asyncio
 import logging
 import re
 import subprocess
 
-import dict_deep
 import discord
 from discord.ext import commands
-from tinydb import Query
 
+from cache import MISSING
 import config
 from consts import *
-
-Servers = Query()
+from indexes import RequestIndex, RoleIndex
+import metrics
+from models import GuildRecord
+import outbound
+from storage import defaultGuildDoc
 
 async def cmdSuccess(ctx, text, *, delete_after=None):
-    return await ctx.send(f'{config.greenTick} {text}', delete_after=delete_after)
+    return await _reply(ctx, f'{config.greenTick} {text}', delete_after)
 
 async def cmdFail(ctx, text, *, delete_after=None):
-    return await ctx.send(f'{config.redTick} {text}', delete_after=delete_after)
+    return await _reply(ctx, f'{config.redTick} {text}', delete_after)
+
+# Replies deleted after a delay go through bot.deletions, which batches deletions per channel
+async def _reply(ctx, content, delete_after):
+    message = await ctx.bot.outbound.call(outbound.INTERACTIVE, 'send', lambda: ctx.send(content))
+    if delete_after is not None: ctx.bot.deletions.schedule(message.channel, message.id, delete_after)
+    return message
 
 def getGitInfo(*, initialize=False, ref_commit=None):
     try:
@@ -43,106 +51,161 @@ def getGitInfo(*, initialize=False, ref_commit=None):
 
     return (version, fork)
 
+# Whether the guild is on one of this process' shards; always true when the bot isn't sharded
+def ownsGuild(bot, guild_id):
+    shard_ids = getattr(bot, 'shard_ids', None)
+    if not bot.shard_count or shard_ids is None: return True
+
+    return (guild_id >> 22) % bot.shard_count in shard_ids
+
 def guild_in_db():
     async def predicate(ctx):
-        if not ctx.bot.db.contains(Servers.id == ctx.guild.id):
-            default_document = {
-                'id': ctx.guild.id, 
-                'requests_opts': {
-                    'channel': None,
-                    'hidejoins': False,
-                    'ratelimit': True
-                }, 
-                'requests': {},
-                'roles': {}
-            }
-
-            ctx.bot.db.insert(default_document)
+        if await getGuildRecord(ctx.bot, ctx.guild): return True
+
+        # Cached before the insert is awaited, so commands that come in meanwhile find the record
+        if ctx.bot.guild_cache.peek(ctx.guild.id) is None:
+            ctx.bot.guild_cache.put(ctx.guild.id, GuildRecord(defaultGuildDoc(ctx.guild.id)))
+            await ctx.bot.db.insert(defaultGuildDoc(ctx.guild.id))
             logging.info(f'[Bot] Guild initalized to database: {ctx.guild} ({ctx.guild.id})')
         return True
     return commands.check(predicate)
 
-def getGuildDoc(bot, guild):
-    return bot.db.get( Servers.id == guild.id )
+# Guild records are served from bot.guild_cache and are shared between callers. Changes are made on the record itself
+# and persisted with saveGuild, which only writes the fields that changed. On a cache miss the record is read on a
+# storage worker thread, and concurrent lookups of the same guild wait for that one read.
+@metrics.timed('getGuildRecord')
+async def getGuildRecord(bot, guild):
+    record = bot.guild_cache.get(guild.id)
+    if record is not MISSING: return record
 
-def guildKeySet(bot, guild, key, val):
-    def predicate(key, val):
-        def transform(doc):
-            dict_deep.deep_set(doc, key, val)
-        return transform
+    load = bot.guild_cache.loading.get(guild.id)
+    if not load:
+        load = bot.guild_cache.loading[guild.id] = asyncio.ensure_future(_loadGuildRecord(bot, guild.id))
 
-    return bot.db.update(predicate(key, val), Servers.id == guild.id)
+    return await asyncio.shield(load)
 
-def guildKeyDel(bot, guild, key):
-    def predicate(key):
-        def transform(doc):
-            dict_deep.deep_del(doc, key)
-        return transform
+async def _loadGuildRecord(bot, guild_id):
+    try:
+        doc = await bot.db.get(guild_id)
+    finally:
+        del bot.guild_cache.loading[guild_id]
+
+    # Keep whatever was cached while the read was in flight, e.g. by removeGuild
+    record = bot.guild_cache.peek(guild_id)
+    if record is MISSING:
+        record = GuildRecord(doc) if doc else None
+        bot.guild_cache.put(guild_id, record)
+
+    return record
+
+# Secondary indexes over the guild's limited requests, kept alongside the cached guild document
+async def getRequestIndex(bot, guild):
+    if not await getGuildRecord(bot, guild): return None
+    return bot.guild_cache.derived(guild.id, 'requests', RequestIndex)
+
+# Requestable roles by id and in display order, kept alongside the cached guild document
+async def getRoleIndex(bot, guild):
+    if not await getGuildRecord(bot, guild): return None
+    return bot.guild_cache.derived(guild.id, 'roles', RoleIndex)
+
+# Writes every change made to the record since it was last saved as a single batch; returns the number of operations.
+# The changes are taken from the record before the write is queued, so saves are written in the order they were made.
+@metrics.timed('saveGuild')
+async def saveGuild(bot, record):
+    ops = record.commit()
+    if ops: await bot.db.apply(ops)
+    return len(ops)
+
+# Returns (member, fetched), looking the member up in the gateway cache, then bot.member_cache, then over REST; member
+# is None if the user isn't in the guild, and fetched is whether a REST call was made
+async def getMember(bot, guild, user_id):
+    member = guild.get_member(user_id)
+    if member: return member, False
+
+    member = bot.member_cache.get(guild.id, user_id)
+    if member is not MISSING: return member, False
+
+    bot.member_cache.fetches += 1
+    try:
+        member = await guild.fetch_member(user_id)
+    except discord.NotFound:
+        member = None
 
-    return bot.db.update(predicate(key), Servers.id == guild.id)
+    bot.member_cache.put(guild.id, user_id, member)
+    return member, True
 
-def removeGuild(bot, guild_id):
+async def removeGuild(bot, guild_id):
     logging.info(f'[Bot] Removed guild from db: {guild_id}')
-    return bot.db.remove(Servers.id == guild_id)
-
-async def sendListEmbed(ctx, title, lst, *, raw_override=None, footer=None):
-    overall_limit = EMBED_LENGTH_LIMITS['overall'] - len(title) - (0 if not footer else len(footer))
-    lengths = list(map(lambda x: len(x), lst))
+    bot.guild_cache.put(guild_id, None)
+    return await bot.db.remove(guild_id)
 
-    lenOverall = 0
-    lastItem = None
+# Splits lines into page descriptions in a single pass, each within the embed description limit
+def paginateLines(lines):
+    pages = []
+    page = []
+    length = 0
 
-    # Start building with description
-    description = ''
-    for i in range(len(lst)):
-        # Description < Overall, so we won't have to worry about hitting it yet; + 1 for newline
-        if len(description) + lengths[i] + 1 > EMBED_LENGTH_LIMITS['description']: break 
+    for line in lines:
+        # + 1 for newline
+        if page and length + len(line) + 1 > EMBED_LENGTH_LIMITS['description']:
+            pages.append('\n'.join(page))
+            page = []
+            length = 0
 
-        description += lst[i] + '\n'
-        lastItem = i
+        page.append(line)
+        length += len(line) + 1
 
-    lenOverall += len(description)
+    if page or not pages:
+        pages.append('\n'.join(page))
 
-    # If description is full, start with fields; 24 Fields, reserve last one for maximum length link
-    fields = []
-    for f in range(24):
-        if lastItem + 1 == len(lst): break
-        if lenOverall + lengths[lastItem+1] + 1 > overall_limit: break
+    return pages
 
-        fields.append('')
-        for i in range(lastItem+1, len(lst)):
-            if lenOverall + len(fields[f]) + lengths[i] + 1 > overall_limit: break
-            if len(fields[f]) + lengths[i] + 1 > EMBED_LENGTH_LIMITS['field_values']: break
+# Sends a list as a single embed message, with reactions to move between pages if it doesn't fit on one. Either
+# pass the lines in lst, or pages already built with paginateLines.
+async def sendListEmbed(ctx, title, lst=None, *, pages=None, footer=None):
+    if pages is None: pages = paginateLines(lst)
 
-            fields[f] += lst[i] + '\n'
-            lastItem = i
+    def page_embed(page):
+        embed = discord.Embed(title=title, description=pages[page])
+        page_footer = f'Page {page+1}/{len(pages)}' if len(pages) > 1 else None
+        footer_text = ' | '.join(filter(None, [page_footer, footer]))
 
-        lenOverall += len(fields[f])
+        if footer_text: embed.set_footer(text=footer_text)
+        return embed
 
-    # If its still too large, send the 'raw' list as a file.
-    if lastItem + 1 < len(lst):
-        fields.append(f'Showing {lastItem+1} items.')
-        raw = '\r\n'.join(lst) if not raw_override else raw_override
-        file = discord.File(fp=io.BytesIO(str.encode(raw)), filename='list.txt')
-    else:
-        file = None
+    message = await ctx.bot.outbound.call(outbound.INTERACTIVE, 'send', lambda: ctx.send(embed=page_embed(0)))
 
-    # Create the embed object (finally)
-    embed = discord.Embed(title=title, description=description)
-    if footer: embed.set_footer(text=footer)
-    for field in fields:
-        embed.add_field(name='\uFEFF', value=field, inline=False) # \uFEFF = ZERO WIDTH NO-BREAK SPACE
+    if len(pages) > 1:
+        ctx.bot.loop.create_task(_paginate(ctx, message, len(pages), page_embed))
 
-    message = await ctx.send(embed=embed, file=file)
+    return message
 
-    # Update the message embed with the file url
-    if file: 
-        url = message.attachments[0].url
-        newValue = fields[len(fields)-1] + f' [See all {len(lst)}.]({url})'
+async def _paginate(ctx, message, page_count, page_embed):
+    page = 0
 
-        embed.remove_field(len(fields)-1)
-        embed.add_field(name='\uFEFF', value=newValue, inline=False)
+    try:
+        for emoji in PAGINATOR_EMOJIS:
+            await ctx.bot.outbound.call(outbound.EMBED, 'reaction', lambda: message.add_reaction(emoji))
+    except discord.HTTPException:
+        return
+
+    # Raw reactions arrive even when the message isn't cached, e.g. without a message cache in low-memory mode
+    def check(payload):
+        return payload.message_id == message.id and payload.user_id == ctx.author.id and \
+            str(payload.emoji) in PAGINATOR_EMOJIS
+
+    while True:
+        try:
+            payload = await ctx.bot.wait_for('raw_reaction_add', check=check, timeout=PAGINATOR_TIMEOUT)
+        except asyncio.TimeoutError:
+            break
+
+        page = (page + (1 if str(payload.emoji) == PAGINATOR_EMOJIS[1] else -1)) % page_count
+        await ctx.bot.outbound.submit(outbound.EMBED, 'reaction',
+            lambda payload=payload: message.remove_reaction(payload.emoji, discord.Object(payload.user_id)))
+        await ctx.bot.outbound.call(outbound.INTERACTIVE, 'edit', lambda: message.edit(embed=page_embed(page)))
 
-        return await message.edit(embed=embed)
-    else:
-        return message
\ No newline at end of file
+    try:
+        await ctx.bot.outbound.call(outbound.EMBED, 'reaction', lambda: message.clear_reactions())
+    except discord.HTTPException:
+        pass